@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Management commands of our app, run them with:
+    flask --app main <command>
+"""
+from bson import ObjectId
+import click
+from datetime import datetime
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+from db import activity, db, leaderboard, timeline
+import jobs
+from timeit import timeit
+
+
+@click.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create the MongoDB indexes that are missing
+    """
+    created = db.ensure_indexes()
+
+    for collection, names in created.items():
+        for name in names:
+            click.echo(f'Created index {collection}.{name}')
+
+    click.echo('Indexes are up to date')
+
+
+@click.command('index-report')
+def index_report_command():
+    """Report missing and unused MongoDB indexes
+    """
+    report = db.index_report()
+
+    for collection, indexes in report.items():
+        click.echo(f'{collection}:')
+        click.echo(f"  missing: {', '.join(indexes['missing']) or '-'}")
+        click.echo(f"  unused: {', '.join(indexes['unused']) or '-'}")
+
+
+@click.command('audit-queries')
+@click.pass_context
+def audit_queries_command(ctx):
+    """Explain the queries DBStorage sends, and fail if any scans a whole
+    collection or sorts in memory unexpectedly
+    """
+    unexpected = 0
+
+    for query in db.audit_queries():
+        if not query['problems']:
+            status = 'ok'
+        elif query['expected']:
+            status = f"expected {', '.join(query['problems'])}"
+        else:
+            status = ', '.join(query['problems'])
+            unexpected += 1
+
+        click.echo(f"{query['collection']}.{query['method']}: {status}")
+        click.echo(f"  query: {query['query']}")
+        if query['sort']:
+            click.echo(f"  sort: {query['sort']}")
+        click.echo(f"  plan: {' <- '.join(query['stages'])}")
+
+    if unexpected:
+        click.echo(f'{unexpected} queries need an index')
+        ctx.exit(1)
+
+
+@click.command('rebuild-timeline')
+def rebuild_timeline_command():
+    """Rebuild the public timeline in Redis from MongoDB
+    """
+    count = timeline.rebuild(db.iter_public_post_dates())
+    click.echo(f'Timeline rebuilt with {count} public posts')
+
+
+@click.command('rebuild-streaks')
+def rebuild_streaks_command():
+    """Recompute every user's streaks from their posts
+    """
+    count = db.rebuild_streaks(current_app.config['STREAK_TTL'],
+                               current_app.config['STREAK_INTERVAL'])
+    click.echo(f'Streaks rebuilt for {count} users')
+
+
+@click.command('backfill-leaderboard')
+def backfill_leaderboard_command():
+    """Rank every user's longest streak on the leaderboard
+    """
+    count = leaderboard.backfill(db.iter_all_users(
+        batch_size=1000,
+        projection={'username': 1, 'longest_streak': 1}
+    ))
+    click.echo(f'Ranked {count} users')
+
+
+@click.command('backfill-activity')
+def backfill_activity_command():
+    """Count every user's entries per day from their posts
+    """
+    count = activity.backfill(db.iter_daily_post_counts())
+    click.echo(f'Counted the entries of {count} days')
+
+
+@click.command('migrate-likes')
+def migrate_likes_command():
+    """Move the likes arrays of posts into the likes collection
+    """
+    moved = db.migrate_likes()
+    click.echo(f'Moved {moved} likes')
+
+
+@click.command('trim-comments-previews')
+def trim_comments_previews_command():
+    """Cut the comments embedded in posts down to their latest ones
+    """
+    trimmed = db.trim_comments_previews()
+    click.echo(f'Trimmed the comments of {trimmed} posts')
+
+
+@click.command('run-worker')
+def run_worker_command():
+    """Run the queued background jobs
+    """
+    click.echo('Waiting for jobs')
+    jobs.work()
+
+
+@click.command('job-status')
+@click.argument('job_id')
+def job_status_command(job_id):
+    """Show the status and progress of a background job
+    """
+    job = jobs.status(job_id)
+    if not job:
+        click.echo(f'Unknown job {job_id}')
+        return
+
+    click.echo(f"{job['name']}: {job['status']} "
+               f"after {job['attempts']} attempt(s)")
+    for name, count in job['progress'].items():
+        click.echo(f'  {name}: {count}')
+    if job['error']:
+        click.echo(f"  last error: {job['error']}")
+
+
+@click.command('benchmark-json')
+@click.option('--posts', default=1000, help='Number of posts in the feed')
+@click.option('--rounds', default=20, help='Number of encodings timed')
+def benchmark_json_command(posts, rounds):
+    """Time encoding a feed with the stdlib JSON provider, converting
+    its ids and dates first, and with the app's provider
+    """
+    feed = [
+        {
+            '_id': ObjectId(),
+            'user_id': str(ObjectId()),
+            'username': f'user{i}',
+            'title': f'Post {i}',
+            'content': 'Lorem ipsum dolor sit amet. ' * 20,
+            'is_public': True,
+            'datePosted': datetime.utcnow(),
+            'number_of_likes': i,
+            'number_of_comments': 3,
+            'liked_by_me': False,
+            'comments': [
+                {
+                    '_id': str(ObjectId()),
+                    'user_id': str(ObjectId()),
+                    'post_id': str(ObjectId()),
+                    'username': f'user{j}',
+                    'body': 'Nice entry!',
+                    'date_posted': 'Mon, 01 Jan 2024 00:00:00 GMT'
+                }
+                for j in range(3)
+            ]
+        }
+        for i in range(posts)
+    ]
+
+    stdlib = DefaultJSONProvider(current_app._get_current_object())
+
+    def convert_and_dump():
+        """Convert the posts as the routes used to, then encode them"""
+        converted = [
+            {**p, '_id': str(p['_id']),
+             'datePosted': p['datePosted'].strftime('%Y/%m/%d %H:%M:%S')}
+            for p in feed
+        ]
+        return stdlib.dumps(converted)
+
+    def dump():
+        """Encode the posts as they are read"""
+        return current_app.json.dumps(feed)
+
+    before = timeit(convert_and_dump, number=rounds) / rounds
+    after = timeit(dump, number=rounds) / rounds
+
+    click.echo(f'Encoding a feed of {posts} posts, over {rounds} rounds:')
+    click.echo(f'  stdlib provider: {before * 1000:.2f} ms')
+    click.echo(f'  app provider:    {after * 1000:.2f} ms')
+    click.echo(f'  speedup:         {before / after:.1f}x')
+
+
+def register_commands(app):
+    """Add our management commands to the app's CLI
+    """
+    app.cli.add_command(ensure_indexes_command)
+    app.cli.add_command(index_report_command)
+    app.cli.add_command(audit_queries_command)
+    app.cli.add_command(rebuild_timeline_command)
+    app.cli.add_command(rebuild_streaks_command)
+    app.cli.add_command(backfill_leaderboard_command)
+    app.cli.add_command(backfill_activity_command)
+    app.cli.add_command(run_worker_command)
+    app.cli.add_command(job_status_command)
+    app.cli.add_command(benchmark_json_command)
+    app.cli.add_command(migrate_likes_command)
+    app.cli.add_command(trim_comments_previews_command)
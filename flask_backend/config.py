@@ -20,8 +20,57 @@ class Config:
     HOST = os.getenv('FLASK_HOST', '0.0.0.0')
     PORT = os.getenv('FLASK_PORT', '5000')
 
+    # Seconds a serialized feed page stays cached (0 disables the cache)
+    FEED_CACHE_TTL = int(os.getenv('FEED_CACHE_TTL', 60))
+
+    # Seconds a validated JWT is trusted without asking Redis again, i.e.
+    # the longest a revocation may take to reach every process if its
+    # pub/sub message is lost (0 disables the cache)
+    TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 5))
+
+    # Processes hashing passwords, and passwords allowed to be hashed or
+    # waiting for them at once: the next ones are answered 503
+    PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', os.cpu_count() or 1))
+    PASSWORD_QUEUE_SIZE = int(os.getenv('PASSWORD_QUEUE_SIZE',
+                                        4 * PASSWORD_WORKERS))
+
+    # Seconds a current streak lives without a new entry, and the least
+    # seconds between two entries: 28h and 20h, or 2 and 1 minutes for
+    # development
+    if os.getenv('MODE') == 'DEV':
+        STREAK_TTL = 120
+        STREAK_INTERVAL = 60
+    else:
+        STREAK_TTL = 28 * 3600
+        STREAK_INTERVAL = 20 * 3600
+
+    # Serve the Prometheus metrics on /metrics. It has no authentication:
+    # only set it where the route can't be reached from the outside
+    SERVE_METRICS = os.getenv('SERVE_METRICS', '0') == '1'
+
+    # Milliseconds beyond which a MongoDB command is logged as slow, with
+    # its query shape and route (0 disables the log)
+    SLOW_QUERY_MS = int(os.getenv('SLOW_QUERY_MS', 100))
+
+    # Run background jobs right away, in the request, instead of queuing
+    # them for the workers
+    JOBS_EAGER = False
+
 
 class TestConfig(Config):
     """Testing configuration for our app
     """
     TESTING = True
+
+    # Tests write posts straight to MongoDB, out of the cache's sight
+    FEED_CACHE_TTL = 0
+
+    # Tests revoke tokens by deleting them straight from Redis
+    TOKEN_CACHE_TTL = 0
+
+    # Days last 2 seconds when testing
+    STREAK_TTL = 4
+    STREAK_INTERVAL = 2
+
+    # Tests check the outcome of jobs as soon as requests return
+    JOBS_EAGER = True
@@ -3,5 +3,15 @@
 """
 from db.db_manager import DBStorage
 from db.redis_client import redis_client
+from metrics import mongo_listener
+from db import (
+    activity,
+    feed_cache,
+    leaderboard,
+    streaks,
+    timeline,
+    token_cache,
+)
 
-db = DBStorage()
+# Account MongoDB's commands in the app's metrics
+db = DBStorage(event_listeners=[mongo_listener])
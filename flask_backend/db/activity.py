@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Daily entry counts of each user, for their activity calendar.
+
+Each user has a Redis hash per year, whose fields are the days ('MM-DD',
+in UTC) they logged entries on and whose values are the entries' count.
+A whole year is read with one HGETALL.
+"""
+from datetime import datetime
+from db.redis_client import redis_client as rc
+from typing import Dict, Iterable, Tuple
+
+# Uncount an entry, forgetting its day once it has none left
+_remove_script = rc.register_script("""
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if count <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return count
+""")
+
+
+def _activity_key(user_id: str, year: int) -> str:
+    """ Return the Redis key of a user's activity in a year """
+    return f'activity:{user_id}:{year}'
+
+
+def add_entry(user_id: str, date_posted: datetime) -> None:
+    """ Count an entry on its day """
+    rc.hincrby(_activity_key(user_id, date_posted.year),
+               date_posted.strftime('%m-%d'), 1)
+
+
+def remove_entry(user_id: str, date_posted: datetime) -> None:
+    """ Uncount a deleted entry from its day """
+    _remove_script(keys=[_activity_key(user_id, date_posted.year)],
+                   args=[date_posted.strftime('%m-%d')])
+
+
+def remove_user(user_id: str) -> None:
+    """ Forget all of a user's activity """
+    keys = list(rc.scan_iter(match=_activity_key(user_id, '*')))
+    if keys:
+        rc.delete(*keys)
+
+
+def year_counts(user_id: str, year: int) -> Dict[str, int]:
+    """ Return the number of entries of a user on each day of a year they
+    logged entries on, by date ('YYYY-MM-DD')
+    """
+    days = rc.hgetall(_activity_key(user_id, year))
+
+    return {
+        f"{year}-{day.decode('utf-8')}": int(count)
+        for day, count in sorted(days.items())
+    }
+
+
+def backfill(counts: Iterable[Tuple[str, str, int]],
+             batch_size: int = 1000) -> int:
+    """ Set the daily counts from (user_id, 'YYYY-MM-DD', count) triples,
+    and return how many days were set
+    """
+    done = 0
+    pipe = rc.pipeline(transaction=False)
+
+    for user_id, day, count in counts:
+        year, month_day = day.split('-', 1)
+        pipe.hset(_activity_key(user_id, int(year)), month_day, count)
+        done += 1
+
+        if done % batch_size == 0:
+            pipe.execute()
+
+    pipe.execute()
+
+    return done
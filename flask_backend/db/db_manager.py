@@ -2,26 +2,33 @@
 """
 Module for managing storage of SWE_journal in MongoDB.
 """
-from pymongo.errors import ConnectionFailure
-from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from pymongo.errors import DuplicateKeyError
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.monitoring import CommandListener
 from pymongo.results import InsertOneResult
 from pymongo import MongoClient
 from bson import ObjectId
+from datetime import datetime
+from db import password_service
+from db.indexes import audit_queries, ensure_indexes, index_report
 import os
-import bcrypt
-from typing import Any, Dict, List, Optional
+import re
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# Number of latest comments embedded in their post
+COMMENTS_PREVIEW_SIZE = 3
 
 
 def hash_pass(password: str) -> bytes:
     """ hash a password and return the hashed value """
-    hash_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-
-    return hash_password
+    return password_service.hash_password(password)
 
 
 def check_hash_password(hashed_password: bytes, password: str) -> bool:
     """ check if hashed value of two string are the same """
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+    return password_service.check_password(hashed_password, password)
 
 
 def serialize_ObjectId(di: dict) -> Dict[str, Any]:
@@ -45,8 +52,11 @@ def serialize_ObjectId(di: dict) -> Dict[str, Any]:
 class DBStorage:
     """ Defines a class that manages storage of SWE_journal in MongoDB. """
 
-    def __init__(self) -> None:
-        """ Constructor """
+    def __init__(
+            self,
+            event_listeners: Optional[List[CommandListener]] = None
+    ) -> None:
+        """ Constructor, with the listeners of the client's commands """
 
         mongo_uri = os.getenv('MONGO_URI')
         with_uri = True
@@ -57,7 +67,8 @@ class DBStorage:
             mongo_uri = f"mongodb://{db_host}:{db_port}"
             with_uri = False
 
-        self._client = MongoClient(mongo_uri)
+        self._client = MongoClient(mongo_uri,
+                                   event_listeners=event_listeners or [])
 
         try:
             self._client.admin.command('ismaster')
@@ -80,6 +91,24 @@ class DBStorage:
             print(f"Connection failed: {err}")
             raise
 
+        # Make sure our queries are backed by indexes
+        self.ensure_indexes()
+
+    # INDEXES
+
+    def ensure_indexes(self) -> Dict[str, List[str]]:
+        """ Create the missing indexes, return the created ones """
+        return ensure_indexes(self._db)
+
+    def index_report(self) -> Dict[str, Dict[str, List[str]]]:
+        """ Return the missing and unused indexes of each collection """
+        return index_report(self._db)
+
+    def audit_queries(self) -> List[Dict[str, Any]]:
+        """ Return the plans of the queries DBStorage sends, with the
+        collection scans and in-memory sorts they do """
+        return audit_queries(self._db)
+
     # INSERT
 
     def insert_user(self, document: Dict[str, Any]) -> InsertOneResult:
@@ -90,6 +119,30 @@ class DBStorage:
         new_user = users.insert_one(document)
         return new_user.inserted_id
 
+    def duplicate_user_field(
+            self,
+            err: DuplicateKeyError,
+            document: Dict[str, Any]
+    ) -> str:
+        """ Return the field, 'email' or 'username', that made a user
+        document break a unique index """
+        details = err.details or {}
+
+        # The server names the duplicated key
+        if details.get('keyPattern'):
+            return next(iter(details['keyPattern']))
+
+        match = re.search(r'index: (\w+)', details.get('errmsg', ''))
+        if match and match.group(1) in ('email', 'username'):
+            return match.group(1)
+
+        # Otherwise, find out which one is taken
+        users = self._db['users']
+        if 'email' in document and users.find_one(
+                {'email': document['email']}, {'_id': 1}):
+            return 'email'
+        return 'username'
+
     def insert_post(self, document: Dict[str, Any]) -> InsertOneResult:
         """ Create a new post document """
         posts = self._db['posts']
@@ -99,12 +152,22 @@ class DBStorage:
 
     # FIND
 
-    def find_user(self, info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """ Return a user document """
+    def find_user(
+            self,
+            info: Dict[str, Any],
+            projection: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """ Return a user document, never with its password """
         users = self._db['users']
+
+        if projection is None:
+            projection = {'password': 0}
+        elif not any(projection.values()):
+            projection = {**projection, 'password': 0}
+
         try:
-            user = users.find(info, {'password': 0})
-            return list(map(serialize_ObjectId, user))[0]
+            user = users.find_one(info, projection)
+            return serialize_ObjectId(user)
 
         except Exception as e:
             return None
@@ -118,12 +181,42 @@ class DBStorage:
         except Exception as e:
             return None
 
+    def authenticate(
+            self,
+            email: str,
+            password: str,
+            timings: Optional[Dict[str, float]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """ Return the user with this email and password, with only its id,
+        username and token epoch, or None if the credentials are wrong.
+
+        If given, `timings` is filled with the seconds spent fetching the
+        user ('db') and checking the password ('hash').
+        """
+        if timings is None:
+            timings = {}
+        users = self._db['users']
+
+        start = perf_counter()
+        user = users.find_one(
+            {'email': email, 'deleted_at': {'$exists': False}},
+            {'username': 1, 'token_epoch': 1, 'password': 1}
+        )
+        timings['db'] = perf_counter() - start
+
+        if not user:
+            return None
+
+        start = perf_counter()
+        verified = check_hash_password(user.pop('password'), password)
+        timings['hash'] = perf_counter() - start
+
+        return serialize_ObjectId(user) if verified else None
+
     def find_user_posts(self, user_id: str) -> Optional[List[Dict[str, Any]]]:
         """ Return a posts documents created by a user. """
-        posts = self._db['posts']
         try:
-            user_posts = posts.find({'user_id': user_id})
-            return list(map(serialize_ObjectId, user_posts))
+            return list(self.iter_user_posts(user_id))
 
         except Exception as e:
             return None
@@ -140,15 +233,184 @@ class DBStorage:
 
     def find_all_users(self) -> List[Dict[str, Any]]:
         """ Returns all users in the db """
-        users = self._db['users']
-
-        return list(map(serialize_ObjectId, users.find({}, {'password': 0})))
+        return list(self.iter_all_users())
 
     def find_all_posts(self) -> List[Dict[str, Any]]:
         """ Returns all posts in the db """
+        return list(self.iter_all_posts())
+
+    def find_feed_posts(
+            self,
+            limit: int = 0,
+            skip: int = 0,
+            after: Optional[Tuple[datetime, ObjectId]] = None
+    ) -> List[Dict[str, Any]]:
+        """ Return public posts from the most to the less recent.
+
+        `after` is a (datePosted, _id) keyset: only the posts coming
+        after it in the feed's order are returned.
+        """
         posts = self._db['posts']
+        query = {'is_public': True}
 
-        return list(map(serialize_ObjectId, posts.find()))
+        if after is not None:
+            date_posted, post_id = after
+            query['$or'] = [
+                {'datePosted': {'$lt': date_posted}},
+                {'datePosted': date_posted, '_id': {'$lt': post_id}}
+            ]
+
+        feed = posts.find(query, {'likes': 0}).sort(
+            [('datePosted', -1), ('_id', -1)]
+        ).skip(skip).limit(limit)
+
+        return list(map(serialize_ObjectId, feed))
+
+    def find_posts_by_ids(self, post_ids: List[str]) -> List[Dict[str, Any]]:
+        """ Return the public posts having the given ids, in the same order.
+        Posts that no longer exist or are private are left out.
+        """
+        if not post_ids:
+            return []
+
+        posts = self._db['posts']
+        found = posts.find(
+            {
+                '_id': {'$in': [ObjectId(i) for i in post_ids]},
+                'is_public': True
+            },
+            {'likes': 0}
+        )
+        by_id = {p['_id']: p for p in map(serialize_ObjectId, found)}
+
+        return [by_id[i] for i in post_ids if i in by_id]
+
+    def iter_public_post_dates(self) -> Iterator[Tuple[str, datetime]]:
+        """ Yield the (_id, datePosted) pairs of all public posts """
+        posts = self._db['posts']
+
+        for p in posts.find({'is_public': True}, {'datePosted': 1}):
+            yield str(p['_id']), p['datePosted']
+
+    def iter_daily_post_counts(self) -> Iterator[Tuple[str, str, int]]:
+        """ Yield the number of posts of each user on each day, as
+        (user_id, 'YYYY-MM-DD', count) """
+        posts = self._db['posts']
+        counts = posts.aggregate([
+            {'$match': {'datePosted': {'$type': 'date'}}},
+            {'$group': {
+                '_id': {
+                    'user_id': '$user_id',
+                    'day': {'$dateToString': {'format': '%Y-%m-%d',
+                                              'date': '$datePosted'}}
+                },
+                'count': {'$sum': 1}
+            }}
+        ], allowDiskUse=True)
+
+        for count in counts:
+            yield (str(count['_id']['user_id']), count['_id']['day'],
+                   count['count'])
+
+    # ITERATE
+
+    # The iter_* methods yield documents lazily, fetching them from the
+    # database `batch_size` at a time, so large results can be processed
+    # in bounded memory. `projection` selects the fields to fetch and
+    # `limit` caps the number of documents (0 for no limit).
+
+    def iter_all_users(
+            self,
+            batch_size: int = 100,
+            projection: Optional[Dict[str, Any]] = None,
+            limit: int = 0
+    ) -> Iterator[Dict[str, Any]]:
+        """ Yield all users in the db, never with their password """
+        users = self._db['users']
+
+        if projection is None:
+            projection = {'password': 0}
+        elif not any(projection.values()):
+            projection = {**projection, 'password': 0}
+
+        cursor = users.find({}, projection).batch_size(batch_size)
+        yield from map(serialize_ObjectId, cursor.limit(limit))
+
+    def iter_all_posts(
+            self,
+            batch_size: int = 100,
+            projection: Optional[Dict[str, Any]] = None,
+            limit: int = 0
+    ) -> Iterator[Dict[str, Any]]:
+        """ Yield all posts in the db """
+        posts = self._db['posts']
+
+        cursor = posts.find({}, projection).batch_size(batch_size)
+        yield from map(serialize_ObjectId, cursor.limit(limit))
+
+    def iter_feed_posts(
+            self,
+            batch_size: int = 100,
+            projection: Optional[Dict[str, Any]] = None,
+            limit: int = 0
+    ) -> Iterator[Dict[str, Any]]:
+        """ Yield all public posts from the most to the less recent """
+        posts = self._db['posts']
+
+        if projection is None:
+            projection = {'likes': 0}
+
+        cursor = posts.find({'is_public': True}, projection).sort(
+            [('datePosted', -1), ('_id', -1)]
+        ).batch_size(batch_size)
+        yield from map(serialize_ObjectId, cursor.limit(limit))
+
+    def iter_user_posts(
+            self,
+            user_id: str,
+            after: Optional[Tuple[datetime, ObjectId]] = None,
+            batch_size: int = 100,
+            projection: Optional[Dict[str, Any]] = None,
+            limit: int = 0
+    ) -> Iterator[Dict[str, Any]]:
+        """ Yield the posts created by a user from the most to the less
+        recent, starting after the (datePosted, _id) keyset `after` if
+        given """
+        posts = self._db['posts']
+
+        query = {'user_id': user_id}
+        if after is not None:
+            date_posted, post_id = after
+            query['$or'] = [
+                {'datePosted': {'$lt': date_posted}},
+                {'datePosted': date_posted, '_id': {'$lt': post_id}}
+            ]
+
+        cursor = posts.find(query, projection).sort(
+            [('datePosted', -1), ('_id', -1)]
+        ).batch_size(batch_size)
+        yield from map(serialize_ObjectId, cursor.limit(limit))
+
+    def iter_post_comments(
+            self,
+            post_id: str,
+            after: Optional[str] = None,
+            batch_size: int = 100,
+            projection: Optional[Dict[str, Any]] = None,
+            limit: int = 0
+    ) -> Iterator[Dict[str, Any]]:
+        """ Yield the comments of a post from the oldest to the newest,
+        starting after the comment whose id is `after` if given """
+        comments = self._db['comments']
+
+        query = {'post_id': ObjectId(post_id)}
+        if after is not None:
+            query['_id'] = {'$gt': ObjectId(after)}
+
+        cursor = comments.find(query, projection).sort(
+            '_id', 1
+        ).batch_size(batch_size)
+        yield from map(serialize_ObjectId, cursor.limit(limit))
 
     # UPDATE
 
@@ -157,7 +419,11 @@ class DBStorage:
             user_id: str,
             update_fields: Dict[str, Any]
     ) -> Optional[Dict[str, Any]]:
-        """ update and return a user document. """
+        """ update and return a user document, or None if there is no such
+        user.
+
+        Raise DuplicateKeyError if the new email or username is used.
+        """
         users = self._db['users']
         update_fields.pop('password', None)
 
@@ -169,20 +435,92 @@ class DBStorage:
                 return_document=ReturnDocument.AFTER
             )
 
-            # If the username was updated, update it also in user's posts
-            new_username = update_fields.get('username')
-            if new_username:
-                posts = self._db['posts']
-                posts.update_many(
-                    {'user_id': user_id},
-                    {'$set': {'username': new_username}},
-                )
-
-            return list(map(serialize_ObjectId, updated_user))[0]
+            # The copies of a new username are updated by propagate_username
+            return serialize_ObjectId(updated_user)
 
+        except DuplicateKeyError:
+            raise
         except Exception as e:
             return None
 
+    def propagate_username(
+            self,
+            user_id: str,
+            old_username: str,
+            new_username: str,
+            batch_size: int = 1000
+    ) -> Iterator[Tuple[str, int]]:
+        """ Update the copies of a user's username, in the user's posts,
+        comments and the comments embedded in posts, and in the legacy
+        likes arrays, a batch at a time.
+
+        Yield the name of the copies and the number updated after each
+        batch. Copies already updated are skipped, so it can be run again.
+        """
+        posts = self._db['posts']
+        comments = self._db['comments']
+
+        # The comments embedded before they were serialized keep their
+        # user_id as an ObjectId
+        embedded_user_id = {'$in': [user_id, ObjectId(user_id)]}
+
+        steps = [
+            ('posts', posts,
+             {'user_id': user_id, 'username': {'$ne': new_username}},
+             {'$set': {'username': new_username}}, {}),
+            ('comments', comments,
+             {'user_id': ObjectId(user_id),
+              'username': {'$ne': new_username}},
+             {'$set': {'username': new_username}}, {}),
+            ('embedded_comments', posts,
+             {'comments': {'$elemMatch': {
+                 'user_id': embedded_user_id,
+                 'username': {'$ne': new_username}
+             }}},
+             {'$set': {'comments.$[c].username': new_username}},
+             {'array_filters': [{'c.user_id': embedded_user_id}]}),
+            ('likes', posts,
+             {'likes': old_username},
+             {'$set': {'likes.$': new_username}}, {}),
+        ]
+
+        for name, collection, query, update, options in steps:
+            while True:
+                ids = [doc['_id'] for doc in
+                       collection.find(query, {'_id': 1}).limit(batch_size)]
+                if not ids:
+                    break
+
+                result = collection.update_many(
+                    {'_id': {'$in': ids}, **query}, update, **options
+                )
+                yield name, result.modified_count
+
+                # Don't spin on documents that can't be updated
+                if not result.modified_count:
+                    break
+
+    def raise_longest_streak(self, user_id: str, streak: int) -> bool:
+        """ Set a user's longest streak to `streak` if it is longer,
+        and tell if it was """
+        users = self._db['users']
+        result = users.update_one(
+            {'_id': ObjectId(user_id), 'longest_streak': {'$lt': streak}},
+            {'$set': {'longest_streak': streak}}
+        )
+        return result.modified_count == 1
+
+    def bump_token_epoch(self, user_id: str) -> int:
+        """ Increment and return the epoch of a user's JWTs """
+        users = self._db['users']
+        user = users.find_one_and_update(
+            {'_id': ObjectId(user_id)},
+            {'$inc': {'token_epoch': 1}},
+            projection={'token_epoch': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return user['token_epoch']
+
     def update_user_password(
             self,
             user_id: str,
@@ -236,59 +574,299 @@ class DBStorage:
         except Exception as e:
             return None
 
-    # FEED'S INTERACTIONS
+    # STREAKS
 
-    def like_post(self, user_id: str, post_id: str) -> bool:
-        """ add likes to a post document. """
+    # Streaks are kept durably in the streaks collection, one document per
+    # user: {'_id': user_id, 'current', 'longest', 'last_entry'}. Redis
+    # only caches the current streaks.
+
+    def find_streak(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """ Return a user's streaks document """
+        streaks = self._db['streaks']
+        return streaks.find_one({'_id': user_id})
+
+    def record_streak_entry(
+            self,
+            user_id: str,
+            streak: int,
+            date: datetime
+    ) -> None:
+        """ Record a user's new current streak, reached by an entry """
+        streaks = self._db['streaks']
+        streaks.update_one(
+            {'_id': user_id},
+            {
+                '$set': {'current': streak, 'last_entry': date},
+                '$max': {'longest': streak}
+            },
+            upsert=True
+        )
+
+    def delete_streak(self, user_id: str) -> None:
+        """ Forget a user's streaks """
+        streaks = self._db['streaks']
+        streaks.delete_one({'_id': user_id})
+
+    def rebuild_streaks(self, ttl: int, interval: int) -> int:
+        """ Recompute every user's streaks from the dates of their posts,
+        raise the users' longest_streak to match, and return the number
+        of users with streaks.
+
+        A post extends the streak if it comes at least `interval` seconds
+        after the previous one. Closer posts count for the same day, and
+        a gap longer than `ttl` seconds starts a new streak. Entries
+        recorded during the rebuild are kept.
+        """
         posts = self._db['posts']
-        post = posts.find_one({'_id': ObjectId(post_id)})
+        ttl_ms, interval_ms = ttl * 1000, interval * 1000
+        gap = {'$subtract': ['$datePosted', '$previous']}
+        # Entries recorded while rebuilding are newer than our results
+        newer = {'$gt': ['$last_entry', '$$new.last_entry']}
+        rebuilt_at = datetime.utcnow()
+
+        posts.aggregate([
+            # Walk each user's posts from the most recent, along the
+            # user_id_datePosted index
+            {'$match': {'datePosted': {'$type': 'date'}}},
+            {'$sort': {'user_id': 1, 'datePosted': -1}},
+            {'$project': {'_id': 0, 'user_id': 1, 'datePosted': 1}},
+            {'$setWindowFields': {
+                'partitionBy': '$user_id',
+                'sortBy': {'datePosted': -1},
+                'output': {
+                    'previous': {'$shift': {'output': '$datePosted',
+                                            'by': 1}}
+                }
+            }},
+            # Tell if each post starts a day, and if it starts a streak
+            {'$set': {
+                'new_day': {'$cond': [
+                    {'$or': [{'$eq': ['$previous', None]},
+                             {'$gte': [gap, interval_ms]}]}, 1, 0
+                ]},
+                'new_streak': {'$cond': [
+                    {'$or': [{'$eq': ['$previous', None]},
+                             {'$gt': [gap, ttl_ms]}]}, 1, 0
+                ]}
+            }},
+            # Number the streaks, the most recent one being 0
+            {'$setWindowFields': {
+                'partitionBy': '$user_id',
+                'sortBy': {'datePosted': -1},
+                'output': {
+                    'streak': {'$sum': '$new_streak',
+                               'window': {'documents': ['unbounded', -1]}}
+                }
+            }},
+            {'$group': {
+                '_id': {'user_id': '$user_id', 'streak': '$streak'},
+                'days': {'$sum': '$new_day'},
+                'last_entry': {'$max': '$datePosted'}
+            }},
+            {'$group': {
+                '_id': '$_id.user_id',
+                'longest': {'$max': '$days'},
+                'current': {'$max': {'$cond': [
+                    {'$eq': ['$_id.streak', 0]}, '$days', 0
+                ]}},
+                'last_entry': {'$max': '$last_entry'}
+            }},
+            # The most recent streak is over if the last entry is too old
+            {'$set': {'current': {'$cond': [
+                {'$gt': [{'$subtract': ['$$NOW', '$last_entry']}, ttl_ms]},
+                0, '$current'
+            ]}}},
+            {'$set': {'rebuilt_at': rebuilt_at}},
+            # Update the streaks in place, keeping the ones of entries
+            # recorded meanwhile
+            {'$merge': {
+                'into': 'streaks',
+                'on': '_id',
+                'whenMatched': [{'$set': {
+                    'current': {'$cond': [newer, '$current',
+                                          '$$new.current']},
+                    'longest': {'$cond': [
+                        newer, {'$max': ['$$new.longest', '$current']},
+                        '$$new.longest'
+                    ]},
+                    'last_entry': {'$max': ['$last_entry',
+                                            '$$new.last_entry']},
+                    'rebuilt_at': '$$new.rebuilt_at'
+                }}],
+                'whenNotMatched': 'insert'
+            }}
+        ], allowDiskUse=True)
+
+        # Forget the streaks of users left without posts
+        self._db['streaks'].delete_many({
+            'rebuilt_at': {'$ne': rebuilt_at},
+            'last_entry': {'$lt': rebuilt_at}
+        })
+
+        # Reconcile the users' longest streaks
+        streaks = self._db['streaks']
         users = self._db['users']
-        user = users.find_one({'_id': ObjectId(user_id)})
+        batch = []
+        for streak in streaks.find({}, {'longest': 1}).batch_size(1000):
+            if not ObjectId.is_valid(streak['_id']):
+                continue
+            batch.append(UpdateOne(
+                {'_id': ObjectId(streak['_id'])},
+                {'$max': {'longest_streak': streak['longest']}}
+            ))
+            if len(batch) == 1000:
+                users.bulk_write(batch, ordered=False)
+                batch = []
+
+        if batch:
+            users.bulk_write(batch, ordered=False)
+
+        return streaks.count_documents({})
 
-        if user['username'] not in post['likes']:
+    # FEED'S INTERACTIONS
+
+    def like_post(self, user_id: str, post_id: str) -> int:
+        """Record a user's like of a post and count it
+
+        Return 0 if successfully liked, otherwise:
+            * -1: post not found
+            * -2: post already liked by the user
+        """
+        posts = self._db['posts']
+        likes = self._db['likes']
+        like = {
+            'post_id': ObjectId(post_id),
+            'user_id': ObjectId(user_id),
+            'date_liked': datetime.utcnow()
+        }
+
+        # The unique (post_id, user_id) index refuses a second like
+        try:
+            likes.insert_one(like)
+        except DuplicateKeyError:
+            return -2
+
+        counted = posts.update_one(
+            {'_id': ObjectId(post_id)},
+            {'$inc': {'number_of_likes': 1}}
+        )
+
+        if not counted.matched_count:
+            likes.delete_one({'_id': like['_id']})
+            return -1
+        return 0
+
+    def unlike_post(self, user_id: str, post_id: str) -> int:
+        """Remove a user's like of a post and uncount it
+
+        Return 0 if successfully unliked, otherwise:
+            * -1: post not found
+            * -2: post not liked by the user
+        """
+        posts = self._db['posts']
+        likes = self._db['likes']
+
+        unliked = likes.delete_one({
+            'post_id': ObjectId(post_id),
+            'user_id': ObjectId(user_id)
+        })
+
+        if unliked.deleted_count:
             posts.update_one(
-                {"_id": ObjectId(post_id)},
-                {
-                    "$inc": {"number_of_likes": 1},
-                    "$addToSet": {"likes": user['username']}
-                }
+                {'_id': ObjectId(post_id)},
+                {'$inc': {'number_of_likes': -1}}
             )
-            return False
-        return True
+            return 0
+
+        # Only look the post up to tell why nothing was unliked
+        if posts.count_documents({'_id': ObjectId(post_id)}, limit=1):
+            return -2
+        return -1
 
-    def unlike_post(self, user_id: str, post_id: str) -> bool:
+    def liked_post_ids(self, user_id: str, post_ids: List[str]) -> Set[str]:
+        """ Return which of the given posts are liked by a user """
+        if not post_ids:
+            return set()
+
+        likes = self._db['likes']
+        liked = likes.find(
+            {
+                'post_id': {'$in': [ObjectId(i) for i in post_ids]},
+                'user_id': ObjectId(user_id)
+            },
+            {'post_id': 1, '_id': 0}
+        )
+
+        return {str(like['post_id']) for like in liked}
+
+    def migrate_likes(self) -> int:
+        """ Move the likes arrays of posts into the likes collection.
+
+        Posts are only stripped of their array once their likes are moved,
+        so an interrupted migration can be run again.
+        Return the number of likes moved.
+        """
         posts = self._db['posts']
-        post = posts.find_one({"_id": ObjectId(post_id)})
         users = self._db['users']
-        user = users.find_one({'_id': ObjectId(user_id)})
+        likes = self._db['likes']
+        moved = 0
+
+        for post in posts.find({'likes': {'$exists': True}}, {'likes': 1}):
+            likers = users.find({'username': {'$in': post['likes']}},
+                                {'_id': 1})
+            new_likes = [
+                {
+                    'post_id': post['_id'],
+                    'user_id': u['_id'],
+                    'date_liked': datetime.utcnow()
+                }
+                for u in likers
+            ]
+
+            if new_likes:
+                try:
+                    moved += len(likes.insert_many(
+                        new_likes, ordered=False
+                    ).inserted_ids)
+                except BulkWriteError as err:
+                    # Likes moved by a previous run are skipped
+                    moved += err.details['nInserted']
 
-        if user['username'] in post['likes']:
             posts.update_one(
-                {"_id": ObjectId(post_id)},
+                {'_id': post['_id']},
                 {
-                    "$inc": {"number_of_likes": -1},
-                    "$pull": {"likes": user['username']}
+                    '$set': {
+                        'number_of_likes': likes.count_documents(
+                            {'post_id': post['_id']}
+                        )
+                    },
+                    '$unset': {'likes': ''}
                 }
             )
-            return False
-        return True
+
+        return moved
 
     def insert_comment(
             self,
             document: Dict[str, Any],
             post_id: str
     ) -> InsertOneResult:
-        """ Create a new comment document """
+        """ Create a new comment document, and keep it in the post's
+        preview of its latest comments """
         posts = self._db['posts']
         comments = self._db['comments']
 
         new_comment = comments.insert_one(document)
-        document['_id'] = str(document['_id'])
         posts.update_one(
             {"_id": ObjectId(post_id)},
             {
                 "$inc": {"number_of_comments": 1},
-                "$addToSet": {"comments": document}
+                "$push": {
+                    "comments": {
+                        "$each": [serialize_ObjectId(document.copy())],
+                        "$slice": -COMMENTS_PREVIEW_SIZE
+                    }
+                }
             }
         )
         return new_comment.inserted_id
@@ -317,14 +895,23 @@ class DBStorage:
             username: str,
             body: Dict[str, Any]
     ) -> Optional[Dict[str, Any]]:
-        """ Updates a comment document. """
+        """ Updates a comment document, and its copy in the post's preview
+        """
         comments = self._db['comments']
+        posts = self._db['posts']
         try:
             updated_comment = comments.find_one_and_update(
                 {'_id': ObjectId(comment_id), 'username': username},
                 {'$set': {'body': body}},
                 return_document=ReturnDocument.AFTER
             )
+            posts.update_one(
+                {
+                    '_id': updated_comment['post_id'],
+                    'comments._id': str(comment_id)
+                },
+                {'$set': {'comments.$.body': body}}
+            )
             return serialize_ObjectId(updated_comment)
 
         except Exception as e:
@@ -340,58 +927,91 @@ class DBStorage:
         comments = self._db['comments']
         posts = self._db['posts']
         try:
-            comments.delete_one({
+            deleted = comments.delete_one({
                 '_id': ObjectId(comment_id),
-                'username': username
+                'username': username,
+                'post_id': ObjectId(post_id)
             })
-            post = posts.find_one({'_id': ObjectId(post_id)})
-
-            for c in post['comments']:
-                if comment_id == c['_id']:
-                    posts.update_one(
-                        {"_id": ObjectId(post_id)},
-                        {
-                            "$inc": {"number_of_comments": -1},
-                            "$pull": {"comments": {'_id': comment_id}}
-                        }
-                    )
-                    return True
+            if not deleted.deleted_count:
+                return False
+
+            # Uncount the comment, and refill the preview if it was there
+            previewed = posts.update_one(
+                {"_id": ObjectId(post_id), "comments._id": str(comment_id)},
+                {"$inc": {"number_of_comments": -1}}
+            )
+            if not previewed.matched_count:
+                posts.update_one(
+                    {"_id": ObjectId(post_id)},
+                    {"$inc": {"number_of_comments": -1}}
+                )
+                return True
+
+            self._refill_comments_preview(ObjectId(post_id))
+            return True
         except Exception as e:
             print(e)
             return False
-        return False
 
-    def get_post_comments(self, post_id: str):
-        """ return all the comment documents
-        associated with a post document. """
-        comments = self._db['comments']
-        try:
-            post_comments = comments.find(
-                {
-                    'post_id': ObjectId(post_id)
-                }
+    def _refill_comments_preview(self, post_id: ObjectId) -> None:
+        """ Embed the latest comments of a post in it again """
+        latest = self._db['comments'].find(
+            {'post_id': post_id}
+        ).sort('_id', -1).limit(COMMENTS_PREVIEW_SIZE)
+        self._db['posts'].update_one(
+            {"_id": post_id},
+            {"$set": {
+                "comments": list(map(serialize_ObjectId, latest))[::-1]
+            }}
+        )
 
-            ).sort('date_posted', 1)
-            return list(map(serialize_ObjectId, post_comments))
+    def get_post_comments(
+            self,
+            post_id: str,
+            after: Optional[str] = None,
+            limit: int = 0
+    ) -> Optional[List[Dict[str, Any]]]:
+        """ return the comment documents associated with a post document,
+        from the oldest to the newest.
+
+        `after` is the id of the comment the page starts after.
+        """
+        try:
+            return list(self.iter_post_comments(post_id, after=after,
+                                                limit=limit))
         except Exception as e:
             return None
 
-    def delete_many_comments(
-            self,
-            post_id: str = None,
-            user_id: str = None
-    ) -> bool:
+    def trim_comments_previews(self) -> int:
+        """ Cut the comments arrays of posts down to their preview size.
+        Return the number of posts trimmed.
+        """
+        posts = self._db['posts']
+        trimmed = posts.update_many(
+            {f'comments.{COMMENTS_PREVIEW_SIZE}': {'$exists': True}},
+            {'$push': {
+                'comments': {'$each': [], '$slice': -COMMENTS_PREVIEW_SIZE}
+            }}
+        )
+        return trimmed.modified_count
+
+    def delete_many_comments(self, post_id: str) -> bool:
         """ Deletes comment documents associated with post document  """
         comments = self._db['comments']
         try:
-            if post_id is not None:
-                comments.delete_many({'post_id': ObjectId(post_id)})
-                return True
-            elif user_id is not None:
-                comments.delete_many({'user_id': ObjectId(user_id)})
-                return True
-            else:
-                return False
+            comments.delete_many({'post_id': ObjectId(post_id)})
+            return True
+        except Exception as e:
+            return False
+
+    def delete_many_likes(self, post_ids: List[str]) -> bool:
+        """ Deletes the likes of posts """
+        likes = self._db['likes']
+        try:
+            likes.delete_many(
+                {'post_id': {'$in': [ObjectId(i) for i in post_ids]}}
+            )
+            return True
         except Exception as e:
             return False
 
@@ -401,11 +1021,15 @@ class DBStorage:
         """ delete a post document from db """
         posts = self._db['posts']
         try:
-            # Revome all comments associated with the post
+            # Revome all comments and likes associated with the post
             deleted = self.delete_many_comments(post_id=post_id)
             if not deleted:
                 return False
 
+            deleted = self.delete_many_likes(post_ids=[post_id])
+            if not deleted:
+                return False
+
             posts.delete_one({
                 '_id': ObjectId(post_id),
                 'user_id': user_id
@@ -414,34 +1038,125 @@ class DBStorage:
         except Exception as e:
             return False
 
-    def delete_user(self, user_id: str) -> bool:
-        """ delete a user from db """
-
-        # First, delete all the user's posts
+    def mark_user_deleted(self, user_id: str) -> bool:
+        """ Flag a user as deleted, so they can't log in while purge_user
+        deletes their data. Return True if the user was found. """
+        users = self._db['users']
+        result = users.update_one(
+            {'_id': ObjectId(user_id)},
+            {'$set': {'deleted_at': datetime.utcnow()}}
+        )
+        return result.matched_count == 1
 
+    def purge_user(
+            self,
+            user_id: str,
+            batch_size: int = 500
+    ) -> Iterator[Tuple[str, List[str]]]:
+        """ Delete a user and everything they left, a batch at a time:
+        their posts with the comments and likes they got, their comments
+        and the copies embedded in other posts, their likes, their streaks
+        and finally the user.
+
+        Yield the name of the documents and the ids deleted or updated
+        after each batch. Each batch leaves the data consistent and only
+        what is left is looked for, so it can be interrupted and run again.
+        """
+        users = self._db['users']
         posts = self._db['posts']
+        comments = self._db['comments']
+        likes = self._db['likes']
 
-        try:
-            # Remove all of the user's comments
-            deleted = self.delete_many_comments(user_id=user_id)
-
-            if not deleted:
-                return False
-            posts.delete_many({
-                'user_id': user_id
-            })
-
-        except Exception as e:
-            return False
-
-        # Then, delete the user himself
+        user = users.find_one({'_id': ObjectId(user_id)}, {'username': 1})
+        if not user:
+            return
+
+        def batches(collection, query, projection=None):
+            """ Yield the documents matching `query`, a batch at a time,
+            until none is left """
+            while True:
+                batch = list(collection.find(
+                    query, projection or {'_id': 1}
+                ).limit(batch_size))
+                if not batch:
+                    return
+                yield batch
+
+        # The user's posts, with their comments and likes
+        for batch in batches(posts, {'user_id': user_id}):
+            ids = [p['_id'] for p in batch]
+            comments.delete_many({'post_id': {'$in': ids}})
+            likes.delete_many({'post_id': {'$in': ids}})
+            posts.delete_many({'_id': {'$in': ids}})
+            yield 'posts', list(map(str, ids))
+
+        def recount(collection, field, batch, legacy=None):
+            """ Set `field` of the posts of a batch of comments or likes to
+            their number once the batch is deleted, plus their `legacy`
+            likes. Counting again, instead of decrementing, keeps the
+            counts right when a batch is run again """
+            ids = [doc['_id'] for doc in batch]
+            legacy = legacy or {}
+            posts.bulk_write([
+                UpdateOne({'_id': post_id}, {'$set': {
+                    field: collection.count_documents(
+                        {'post_id': post_id, '_id': {'$nin': ids}}
+                    ) + legacy.get(post_id, 0)
+                }})
+                for post_id in {doc['post_id'] for doc in batch}
+            ], ordered=False)
+
+        # The user's comments on other posts, uncounted from them
+        for batch in batches(comments, {'user_id': ObjectId(user_id)},
+                             {'post_id': 1}):
+            recount(comments, 'number_of_comments', batch)
+            ids = [c['_id'] for c in batch]
+            comments.delete_many({'_id': {'$in': ids}})
+            yield 'comments', list(map(str, ids))
+
+        # The previews still embedding the user's comments, whose user_id
+        # is an ObjectId in the previews written before they were serialized
+        previewed = {'comments.user_id': {'$in': [user_id, ObjectId(user_id)]}}
+        for batch in batches(posts, previewed):
+            for p in batch:
+                self._refill_comments_preview(p['_id'])
+            yield 'comments_previews', [str(p['_id']) for p in batch]
+
+        # The user's likes, uncounted from the posts they liked, which
+        # may still count the likes of their arrays
+        for batch in batches(likes, {'user_id': ObjectId(user_id)},
+                             {'post_id': 1}):
+            liked = posts.find(
+                {'_id': {'$in': [like['post_id'] for like in batch]},
+                 'likes': {'$exists': True}},
+                {'likes': 1}
+            )
+            recount(likes, 'number_of_likes', batch,
+                    {p['_id']: len(p['likes']) for p in liked})
+            ids = [like['_id'] for like in batch]
+            likes.delete_many({'_id': {'$in': ids}})
+            yield 'likes', list(map(str, ids))
+
+        # The user's likes not migrated out of the likes arrays yet
+        for batch in batches(posts, {'likes': user['username']}):
+            ids = [p['_id'] for p in batch]
+            posts.update_many(
+                {'_id': {'$in': ids}, 'likes': user['username']},
+                {'$pull': {'likes': user['username']},
+                 '$inc': {'number_of_likes': -1}}
+            )
+            yield 'legacy_likes', list(map(str, ids))
 
-        users = self._db['users']
+        # Then, the user himself
+        self.delete_streak(user_id)
+        users.delete_one({'_id': ObjectId(user_id)})
+        yield 'users', [user_id]
 
+    def delete_user(self, user_id: str) -> bool:
+        """ delete a user from db, with all their data """
         try:
-            users.delete_one({
-                '_id': ObjectId(user_id)
-            })
+            for _ in self.purge_user(user_id):
+                pass
 
         except Exception as e:
             return False
@@ -455,3 +1170,6 @@ class DBStorage:
         self._db.drop_collection('users')
         self._db.drop_collection('posts')
         self._db.drop_collection('comments')
+        self._db.drop_collection('likes')
+        self._db.drop_collection('streaks')
+        self.ensure_indexes()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Cache of serialized feed pages in Redis.
+
+Pages are stored under the current feed version: bumping the version on
+every write to the feed makes all the cached pages stale at once, and
+they expire on their own.
+"""
+from db.redis_client import redis_client as rc
+from typing import Dict, Optional, Tuple
+
+VERSION_KEY = 'feed:version'
+HITS_KEY = 'feed:cache:hits'
+MISSES_KEY = 'feed:cache:misses'
+
+# Read the feed version and the page cached under it, counting the
+# lookup as a hit or a miss, in a single round trip
+_lookup_script = rc.register_script("""
+local version = redis.call('GET', KEYS[1]) or '0'
+local page = redis.call('GET', 'feed:page:' .. version .. ':' .. ARGV[1])
+if page then
+    redis.call('INCR', KEYS[2])
+else
+    redis.call('INCR', KEYS[3])
+end
+return {version, page}
+""")
+
+
+def _page_key(version: int, name: str) -> str:
+    """ Return the Redis key of a cached page """
+    return f'feed:page:{version}:{name}'
+
+
+def lookup(name: str) -> Tuple[int, Optional[bytes]]:
+    """ Return the current feed version and the page cached under it,
+    or None if that page is not cached.
+    """
+    version, page = _lookup_script(keys=[VERSION_KEY, HITS_KEY, MISSES_KEY],
+                                   args=[name])
+    return int(version), page
+
+
+def store(version: int, name: str, page: bytes, ttl: int) -> None:
+    """ Cache a page for `ttl` seconds under the feed version it was
+    computed from.
+    """
+    rc.setex(_page_key(version, name), ttl, page)
+
+
+def bump() -> None:
+    """ Invalidate every cached page """
+    rc.incr(VERSION_KEY)
+
+
+def stats() -> Dict[str, float]:
+    """ Return the cache's hits, misses and hit rate """
+    hits, misses = (int(v or 0) for v in rc.mget(HITS_KEY, MISSES_KEY))
+    lookups = hits + misses
+
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups else 0.0
+    }
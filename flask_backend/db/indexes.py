@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Registry of the MongoDB indexes SWE_journal relies on, and helpers to
+apply and audit them.
+"""
+from bson import ObjectId
+from datetime import datetime
+import logging
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# The indexes every collection should have, by collection name
+INDEXES: Dict[str, List[IndexModel]] = {
+    'users': [
+        # find_user({'email': ...}) and email uniqueness
+        IndexModel([('email', ASCENDING)], name='email', unique=True),
+        # find_user({'username': ...}) and username uniqueness
+        IndexModel([('username', ASCENDING)], name='username', unique=True),
+    ],
+    'posts': [
+        # find_user_posts, sorted from the most to the less recent with
+        # the _id tie-breaker
+        IndexModel(
+            [
+                ('user_id', ASCENDING),
+                ('datePosted', DESCENDING),
+                ('_id', DESCENDING)
+            ],
+            name='user_id_datePosted'
+        ),
+        # find_feed_posts, with the _id tie-breaker of the feed's order
+        IndexModel(
+            [
+                ('is_public', ASCENDING),
+                ('datePosted', DESCENDING),
+                ('_id', DESCENDING)
+            ],
+            name='is_public_datePosted'
+        ),
+        # The comments embedded in posts, by their author
+        IndexModel([('comments.user_id', ASCENDING)],
+                   name='comments.user_id'),
+    ],
+    'comments': [
+        # get_post_comments' pages and delete_many_comments
+        IndexModel(
+            [('post_id', ASCENDING), ('_id', ASCENDING)],
+            name='post_id__id'
+        ),
+        # purge_user and propagate_username
+        IndexModel([('user_id', ASCENDING)], name='user_id'),
+    ],
+    'likes': [
+        # One like per user and post, and liked_post_ids
+        IndexModel(
+            [('post_id', ASCENDING), ('user_id', ASCENDING)],
+            name='post_id_user_id',
+            unique=True
+        ),
+        # purge_user
+        IndexModel([('user_id', ASCENDING)], name='user_id'),
+    ],
+}
+
+
+# Indexes no longer declared, dropped from existing databases, by
+# collection name
+RETIRED_INDEXES: Dict[str, List[str]] = {
+    # Replaced by post_id__id
+    'comments': ['post_id_date_posted'],
+}
+
+# Sample values of the query shapes
+_OID = ObjectId()
+_USER_ID = str(ObjectId())
+_DATE = datetime(2024, 1, 1)
+
+# The query shapes DBStorage sends, with sample values, as
+# (DBStorage method, collection, filter, sort, expected full scan).
+# Only maintenance methods may scan a whole collection.
+QUERY_SHAPES: List[Tuple[str, str, Dict, Optional[Dict], bool]] = [
+    ('find_user', 'users', {'_id': _OID}, None, False),
+    ('authenticate', 'users',
+     {'email': 'a@b.c', 'deleted_at': {'$exists': False}}, None, False),
+    ('find_user', 'users', {'username': 'user'}, None, False),
+    ('find_post', 'posts', {'_id': _OID, 'user_id': _USER_ID}, None, False),
+    ('find_feed_posts', 'posts', {'is_public': True},
+     {'datePosted': -1, '_id': -1}, False),
+    ('find_feed_posts', 'posts', {
+        'is_public': True,
+        '$or': [{'datePosted': {'$lt': _DATE}},
+                {'datePosted': _DATE, '_id': {'$lt': _OID}}]
+    }, {'datePosted': -1, '_id': -1}, False),
+    ('find_posts_by_ids', 'posts',
+     {'_id': {'$in': [_OID]}, 'is_public': True}, None, False),
+    ('find_user_posts', 'posts', {'user_id': _USER_ID},
+     {'datePosted': -1, '_id': -1}, False),
+    ('iter_user_posts', 'posts', {
+        'user_id': _USER_ID,
+        '$or': [{'datePosted': {'$lt': _DATE}},
+                {'datePosted': _DATE, '_id': {'$lt': _OID}}]
+    }, {'datePosted': -1, '_id': -1}, False),
+    ('iter_public_post_dates', 'posts', {'is_public': True}, None, False),
+    ('propagate_username', 'posts',
+     {'user_id': _USER_ID, 'username': {'$ne': 'user'}}, None, False),
+    ('propagate_username', 'comments',
+     {'user_id': _OID, 'username': {'$ne': 'user'}}, None, False),
+    ('propagate_username', 'posts',
+     {'comments': {'$elemMatch': {'user_id': {'$in': [_USER_ID, _OID]},
+                                  'username': {'$ne': 'user'}}}},
+     None, False),
+    ('propagate_username', 'posts', {'likes': 'user'}, None, True),
+    ('purge_user', 'posts',
+     {'comments.user_id': {'$in': [_USER_ID, _OID]}}, None, False),
+    ('migrate_likes', 'posts', {'likes': {'$exists': True}}, None, True),
+    ('migrate_likes', 'users', {'username': {'$in': ['user']}}, None, False),
+    ('trim_comments_previews', 'posts', {'comments.3': {'$exists': True}},
+     None, True),
+    ('get_post_comments', 'comments',
+     {'post_id': _OID, '_id': {'$gt': _OID}}, {'_id': 1}, False),
+    ('delete_comment', 'comments', {'post_id': _OID}, {'_id': -1}, False),
+    ('purge_user', 'comments', {'post_id': _OID, '_id': {'$nin': [_OID]}},
+     None, False),
+    ('find_comment', 'comments', {'_id': _OID, 'username': 'user'},
+     None, False),
+    ('purge_user', 'comments', {'user_id': _OID}, None, False),
+    ('unlike_post', 'likes', {'post_id': _OID, 'user_id': _OID}, None,
+     False),
+    ('liked_post_ids', 'likes',
+     {'post_id': {'$in': [_OID]}, 'user_id': _OID}, None, False),
+    ('purge_user', 'likes', {'user_id': _OID}, None, False),
+    ('purge_user', 'likes', {'post_id': _OID, '_id': {'$nin': [_OID]}},
+     None, False),
+    ('find_streak', 'streaks', {'_id': _USER_ID}, None, False),
+    ('rebuild_streaks', 'streaks',
+     {'rebuilt_at': {'$ne': _DATE}, 'last_entry': {'$lt': _DATE}},
+     None, True),
+]
+
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """ Return the stages of a query plan, from the root down """
+    stages = [plan['stage']] if 'stage' in plan else []
+
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += _plan_stages(child)
+
+    return stages
+
+
+def audit_queries(database: Database) -> List[Dict[str, Any]]:
+    """ Explain every query shape of QUERY_SHAPES, and report for each its
+    plan's stages and problems: COLLSCAN when it scans the whole
+    collection, SORT when it sorts in memory instead of reading an index
+    in order.
+    """
+    report = []
+
+    for method, collection_name, query, sort, full_scan in QUERY_SHAPES:
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(list(sort.items()))
+
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = _plan_stages(plan)
+        problems = sorted({s for s in stages if s in ('COLLSCAN', 'SORT')})
+
+        report.append({
+            'method': method,
+            'collection': collection_name,
+            'query': query_shape(query),
+            'sort': sort,
+            'stages': stages,
+            'problems': problems,
+            'expected': full_scan and problems == ['COLLSCAN']
+        })
+
+    return report
+
+
+def query_shape(value: Any) -> Any:
+    """ Return the shape of a query: its fields and operators, with '?'
+    for their values """
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(v) for v in value if isinstance(v, dict)] or '?'
+    return '?'
+
+
+def command_shape(name: str, command: Dict[str, Any]) -> Dict[str, Any]:
+    """ Return the collection and query shape of a MongoDB command """
+    collection = command.get(name)
+    if not isinstance(collection, str):
+        # e.g. getMore, whose collection comes apart from its cursor id
+        collection = command.get('collection')
+
+    if name == 'find':
+        query = command.get('filter', {})
+    elif name in ('update', 'delete'):
+        statements = command.get(f'{name}s', [])
+        query = statements[0].get('q', {}) if statements else {}
+    elif name == 'aggregate':
+        query = command.get('pipeline', [])
+    else:
+        query = command.get('query', {})
+
+    shape = {'collection': collection, 'query': query_shape(query)}
+    if 'sort' in command:
+        shape['sort'] = dict(command['sort'])
+
+    return shape
+
+
+def _same_index(existing: Dict, index: IndexModel) -> bool:
+    """ Tell if an existing index matches its declaration """
+    spec = index.document
+    return (list(existing['key']) == list(spec['key'].items())
+            and existing.get('unique', False) == spec.get('unique', False))
+
+
+def ensure_indexes(database: Database) -> Dict[str, List[str]]:
+    """ Create the declared indexes missing from the database, and drop
+    the retired ones.
+
+    An index whose name is taken by another definition is rebuilt.
+    Safe to run as often as needed: return the names of the indexes
+    created, by collection. A unique index that cannot be built, e.g.
+    because of duplicates, raises OperationFailure.
+    """
+    for collection_name, names in RETIRED_INDEXES.items():
+        collection = database[collection_name]
+        for name in names:
+            if name in collection.index_information():
+                collection.drop_index(name)
+                logger.info('Dropped retired index %s.%s',
+                            collection_name, name)
+
+    created = {}
+
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        existing = collection.index_information()
+        created[collection_name] = []
+
+        for index in indexes:
+            name = index.document['name']
+
+            if name in existing:
+                if _same_index(existing[name], index):
+                    continue
+                collection.drop_index(name)
+
+            try:
+                collection.create_indexes([index])
+                created[collection_name].append(name)
+            except OperationFailure as err:
+                logger.error('Could not create index %s.%s: %s',
+                             collection_name, name, err)
+                # The app must not run without the constraint it relies on
+                if index.document.get('unique'):
+                    raise
+
+    return created
+
+
+def index_report(database: Database) -> Dict[str, Dict[str, List[str]]]:
+    """ Report, by collection, the declared indexes that are missing
+    and the existing ones that were never used since the server started.
+    """
+    report = {}
+
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        existing = collection.index_information()
+
+        missing = [
+            index.document['name'] for index in indexes
+            if index.document['name'] not in existing
+            or not _same_index(existing[index.document['name']], index)
+        ]
+
+        try:
+            stats = collection.aggregate([{'$indexStats': {}}])
+            unused = sorted(
+                s['name'] for s in stats
+                if s['name'] != '_id_' and s['accesses']['ops'] == 0
+            )
+        except OperationFailure:
+            # Usage statistics are not available on this server
+            unused = []
+
+        report[collection_name] = {'missing': missing, 'unused': unused}
+
+    return report
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Streak leaderboards, kept in Redis sorted sets of user ids scored by
+their longest and current streaks.
+
+Current streaks end on their own: each one is also scored by its expiry
+in a side sorted set, and the ended ones are pruned before every read.
+"""
+from db.redis_client import redis_client as rc
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+LONGEST_KEY = 'leaderboard:longest'
+CURRENT_KEY = 'leaderboard:current'
+EXPIRY_KEY = 'leaderboard:current:expiry'
+USERNAMES_KEY = 'leaderboard:usernames'
+
+BOARDS = {'longest': LONGEST_KEY, 'current': CURRENT_KEY}
+
+# Remove the current streaks that ended, a batch at a time
+_prune_script = rc.register_script("""
+local ended = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1],
+                         'LIMIT', 0, 1000)
+if #ended > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ended))
+    redis.call('ZREM', KEYS[2], unpack(ended))
+end
+return #ended
+""")
+
+
+def record(user_id: str, username: str, streak: int, ttl: int) -> None:
+    """ Rank a user's current streak, alive for `ttl` seconds, and their
+    longest streak if this one is longer
+    """
+    pipe = rc.pipeline(transaction=False)
+    pipe.zadd(CURRENT_KEY, {user_id: streak})
+    pipe.zadd(EXPIRY_KEY, {user_id: time() + ttl})
+    pipe.zadd(LONGEST_KEY, {user_id: streak}, gt=True)
+    pipe.hset(USERNAMES_KEY, user_id, username)
+    pipe.execute()
+
+
+def rename(user_id: str, username: str) -> None:
+    """ Show a user's new username on the leaderboards """
+    if rc.hexists(USERNAMES_KEY, user_id):
+        rc.hset(USERNAMES_KEY, user_id, username)
+
+
+def remove_user(user_id: str) -> None:
+    """ Withdraw a user from the leaderboards """
+    pipe = rc.pipeline(transaction=False)
+    for key in (LONGEST_KEY, CURRENT_KEY, EXPIRY_KEY):
+        pipe.zrem(key, user_id)
+    pipe.hdel(USERNAMES_KEY, user_id)
+    pipe.execute()
+
+
+def standings(
+        board: str,
+        count: int,
+        user_id: str
+) -> Tuple[List[Dict], Optional[Dict]]:
+    """ Return the top `count` users of a board, and the rank and streak
+    of a user, or None if they are not ranked.
+    """
+    key = BOARDS[board]
+
+    pipe = rc.pipeline(transaction=False)
+    if key == CURRENT_KEY:
+        _prune_script(keys=[CURRENT_KEY, EXPIRY_KEY], args=[time()],
+                      client=pipe)
+    pipe.zrevrange(key, 0, count - 1, withscores=True)
+    pipe.zrevrank(key, user_id)
+    pipe.zscore(key, user_id)
+    *_, top, rank, score = pipe.execute()
+
+    ids = [member.decode('utf-8') for member, _ in top]
+    usernames = rc.hmget(USERNAMES_KEY, ids) if ids else []
+
+    top = [
+        {
+            'rank': i + 1,
+            'user_id': member,
+            'username': username.decode('utf-8') if username else None,
+            'streak': int(streak)
+        }
+        for i, (member, username, (_, streak))
+        in enumerate(zip(ids, usernames, top))
+    ]
+    me = None if rank is None else {'rank': rank + 1, 'streak': int(score)}
+
+    return top, me
+
+
+def backfill(users: Iterable[Dict], batch_size: int = 1000) -> int:
+    """ Rank the longest streaks of users documents, keeping the longer
+    streaks already ranked, and return how many were ranked.
+    """
+    count = 0
+    pipe = rc.pipeline(transaction=False)
+
+    for user in users:
+        if not user.get('longest_streak'):
+            continue
+
+        pipe.zadd(LONGEST_KEY, {user['_id']: user['longest_streak']},
+                  gt=True)
+        pipe.hset(USERNAMES_KEY, user['_id'], user['username'])
+        count += 1
+
+        if count % batch_size == 0:
+            pipe.execute()
+
+    pipe.execute()
+
+    return count
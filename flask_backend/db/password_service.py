@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Password hashing service.
+
+bcrypt is slow on purpose: hashing or checking a password costs tens of
+milliseconds of CPU. The work runs in a pool of processes, the app's
+PASSWORD_WORKERS. The request thread still waits for its result, but it
+doesn't hold the GIL meanwhile, so the other request threads keep
+running. At most PASSWORD_QUEUE_SIZE passwords may wait for the pool at
+once, the next ones are rejected right away.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask
+import multiprocessing
+from threading import BoundedSemaphore, Lock
+import bcrypt
+import os
+
+# Processes hashing passwords, until the app's configuration is applied
+WORKERS = os.cpu_count() or 1
+
+# Workers are started from a clean process, not forked from the app's
+# threads and connections. They only load bcrypt.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _context = multiprocessing.get_context('forkserver')
+    _context.set_forkserver_preload(['bcrypt'])
+else:
+    _context = multiprocessing.get_context('spawn')
+
+_slots = BoundedSemaphore(4 * WORKERS)
+_lock = Lock()
+_pool = None
+_pool_pid = None
+
+
+def init_app(app: Flask) -> None:
+    """ Size the pool and its queue from the app's configuration """
+    global WORKERS, _slots, _pool
+
+    with _lock:
+        if app.config['PASSWORD_WORKERS'] != WORKERS and _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+        WORKERS = app.config['PASSWORD_WORKERS']
+        _slots = BoundedSemaphore(app.config['PASSWORD_QUEUE_SIZE'])
+
+
+class PasswordServiceBusy(Exception):
+    """Raised when too many passwords are waiting to be hashed"""
+
+
+def _executor() -> ProcessPoolExecutor:
+    """ Return the process pool, created on first use in each process """
+    global _pool, _pool_pid
+
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=WORKERS,
+                                        mp_context=_context)
+            _pool_pid = os.getpid()
+
+    return _pool
+
+
+def _discard(pool: ProcessPoolExecutor) -> None:
+    """ Forget a broken pool, for the next call to start a new one """
+    global _pool
+
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _run(func, *args):
+    """ Run a function in the pool and return its result, or raise
+    PasswordServiceBusy if the queue is full
+    """
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise PasswordServiceBusy()
+
+    try:
+        pool = _executor()
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for lack of memory
+            _discard(pool)
+            return _executor().submit(func, *args).result()
+    finally:
+        slots.release()
+
+
+def hash_password(password: str) -> bytes:
+    """ Hash a password and return the hashed value """
+    return _run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
+
+
+def check_password(hashed_password: bytes, password: str) -> bool:
+    """ Check if a password matches its hashed value """
+    return _run(bcrypt.checkpw, password.encode('utf-8'), hashed_password)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Cache of the current streaks in Redis, under a key per user that expires
+when the user stops logging entries.
+
+The streaks are stored durably in MongoDB: a streak missing from the
+cache is seeded from there before being extended.
+"""
+from datetime import datetime
+from db.redis_client import redis_client as rc
+from typing import Any, Dict, Optional, Tuple
+
+# Check the interval since the last entry and extend the streak, in one
+# atomic step. Return the new streak and 0, or the current streak and the
+# seconds left before a new entry is allowed. If the streak is not cached
+# and no seed is given, return -1 and 0.
+_log_script = rc.register_script("""
+local ttl = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local streak = redis.call('GET', KEYS[1])
+if not streak then
+    if not ARGV[3] then
+        return {-1, 0}
+    end
+    streak = ARGV[3]
+    if tonumber(streak) > 0 then
+        redis.call('SET', KEYS[1], streak, 'PX', ARGV[4])
+    end
+end
+streak = tonumber(streak)
+if streak > 0 then
+    local left = redis.call('TTL', KEYS[1]) - (ttl - interval)
+    if left > 0 then
+        return {streak, left}
+    end
+end
+streak = streak + 1
+redis.call('SETEX', KEYS[1], ttl, streak)
+return {streak, 0}
+""")
+
+
+def streak_key(username: str) -> str:
+    """ Return the Redis key of a user's current streak """
+    return f'{username}_CS'
+
+
+def alive_streak(
+        document: Optional[Dict[str, Any]],
+        ttl: int
+) -> Tuple[int, int]:
+    """ Return the current streak of a streaks document and the
+    milliseconds it has left, or 0 and 0 if it is over.
+    """
+    if not document or not document.get('current'):
+        return 0, 0
+
+    elapsed = datetime.utcnow() - document['last_entry']
+    left = ttl * 1000 - int(elapsed.total_seconds() * 1000)
+    if left <= 0:
+        return 0, 0
+
+    return document['current'], left
+
+
+def log_entry(
+        username: str,
+        ttl: int,
+        interval: int,
+        seed: Optional[Tuple[int, int]] = None
+) -> Tuple[Optional[int], int]:
+    """ Extend a user's current streak for `ttl` seconds, unless their
+    last entry is less than `interval` seconds old.
+
+    Return the new streak and 0, or the current streak and the seconds
+    to wait before the next entry. If the streak is not cached, return
+    None and 0 unless a `seed` is given: the streak and the milliseconds
+    it has left, as found by alive_streak.
+    """
+    args = [ttl, interval]
+    if seed is not None:
+        args.extend(seed)
+
+    streak, wait = _log_script(keys=[streak_key(username)], args=args)
+    if streak < 0:
+        return None, 0
+
+    return int(streak), int(wait)
+
+
+def cached_streak(username: str) -> Optional[Tuple[int, int]]:
+    """ Return a user's cached current streak and the seconds it has left,
+    or None if it is not cached.
+    """
+    pipe = rc.pipeline()
+    pipe.get(streak_key(username))
+    pipe.ttl(streak_key(username))
+    streak, ttl = pipe.execute()
+
+    if streak is None:
+        return None
+
+    return int(streak), ttl
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Precomputed public timeline: the ids of the public posts, kept in a Redis
+sorted set scored by their datePosted.
+"""
+from calendar import timegm
+from datetime import datetime
+from db.redis_client import redis_client as rc
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Sorted set of public post ids
+TIMELINE_KEY = 'timeline:public'
+
+# Set once the timeline holds every public post
+BUILT_KEY = 'timeline:public:built'
+
+# The timeline being rebuilt, set while it is, and the posts removed
+# meanwhile
+REBUILD_KEY = TIMELINE_KEY + ':rebuilding'
+REBUILDING_KEY = TIMELINE_KEY + ':rebuilding:started'
+REMOVED_KEY = TIMELINE_KEY + ':rebuilding:removed'
+
+# Seconds a rebuild may go without progress before writes stop being
+# copied to it
+REBUILD_TTL = 600
+
+_KEYS = [TIMELINE_KEY, REBUILDING_KEY, REBUILD_KEY, REMOVED_KEY]
+
+# Add a post to the timeline, and to the one being rebuilt if any
+_add_script = rc.register_script("""
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+    redis.call('SREM', KEYS[4], ARGV[1])
+end
+""")
+
+# Remove posts from the timeline, and from the one being rebuilt if any,
+# remembering them until the rebuilt one is swapped in
+_remove_script = rc.register_script("""
+redis.call('ZREM', KEYS[1], unpack(ARGV))
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('ZREM', KEYS[3], unpack(ARGV))
+    redis.call('SADD', KEYS[4], unpack(ARGV))
+end
+""")
+
+# Swap the rebuilt timeline in, without the posts removed during the
+# rebuild, which it may have read before they were
+_swap_script = rc.register_script("""
+for _, post_id in ipairs(redis.call('SMEMBERS', KEYS[4])) do
+    redis.call('ZREM', KEYS[3], post_id)
+end
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('RENAME', KEYS[3], KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+redis.call('DEL', KEYS[2], KEYS[4])
+redis.call('SET', KEYS[5], 1)
+""")
+
+# Return a page of the timeline by rank, or nil if it was never built
+_page_script = rc.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return false
+end
+return redis.call('ZREVRANGE', KEYS[1], ARGV[1], ARGV[2])
+""")
+
+# Return the page following a post, or nil if the timeline was never built.
+# If the post left the timeline, continue from its score instead.
+_page_after_script = rc.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return false
+end
+local count = tonumber(ARGV[3])
+local rank = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+if rank then
+    return redis.call('ZREVRANGE', KEYS[1], rank + 1, rank + count)
+end
+return redis.call('ZREVRANGEBYSCORE', KEYS[1], '(' .. ARGV[2], '-inf',
+                  'LIMIT', 0, count)
+""")
+
+
+def _score(date_posted: datetime) -> float:
+    """ Return the timeline score of a post: its UTC timestamp """
+    return timegm(date_posted.utctimetuple()) + \
+        date_posted.microsecond / 1e6
+
+
+def add_post(post_id: str, date_posted: datetime) -> None:
+    """ Add a public post to the timeline """
+    _add_script(keys=_KEYS, args=[str(post_id), _score(date_posted)])
+
+
+def remove_posts(*post_ids: str) -> None:
+    """ Remove posts from the timeline """
+    if post_ids:
+        _remove_script(keys=_KEYS, args=list(map(str, post_ids)))
+
+
+def page(start: int, count: int) -> Optional[List[str]]:
+    """ Return `count` post ids from the `start` rank of the timeline,
+    or None if it has not been built yet.
+    """
+    ids = _page_script(keys=[TIMELINE_KEY, BUILT_KEY],
+                       args=[start, start + count - 1])
+    if ids is None:
+        return None
+    return [i.decode('utf-8') for i in ids]
+
+
+def page_after(
+        post_id: str,
+        date_posted: datetime,
+        count: int
+) -> Optional[List[str]]:
+    """ Return the `count` post ids following a post in the timeline,
+    or None if it has not been built yet.
+    """
+    ids = _page_after_script(keys=[TIMELINE_KEY, BUILT_KEY],
+                             args=[str(post_id), repr(_score(date_posted)),
+                                   count])
+    if ids is None:
+        return None
+    return [i.decode('utf-8') for i in ids]
+
+
+def rebuild(posts: Iterable[Tuple[str, datetime]],
+            batch_size: int = 1000) -> int:
+    """ Rebuild the timeline from (post_id, datePosted) pairs of every
+    public post, and return how many were added.
+
+    The new timeline is filled aside, then swapped in at once. Posts
+    added or removed meanwhile are added to or removed from it as well,
+    so the swap loses none of them.
+    """
+    pipe = rc.pipeline()
+    pipe.delete(REBUILD_KEY, REMOVED_KEY)
+    pipe.setex(REBUILDING_KEY, REBUILD_TTL, 1)
+    pipe.execute()
+
+    count = 0
+    batch = {}
+    for post_id, date_posted in posts:
+        batch[str(post_id)] = _score(date_posted)
+        if len(batch) == batch_size:
+            _add_batch(batch)
+            count += len(batch)
+            batch = {}
+
+    if batch:
+        _add_batch(batch)
+        count += len(batch)
+
+    _swap_script(keys=_KEYS + [BUILT_KEY])
+
+    return count
+
+
+def _add_batch(batch: Dict[str, float]) -> None:
+    """ Add a batch of posts to the timeline being rebuilt, and keep the
+    rebuild alive """
+    pipe = rc.pipeline()
+    pipe.zadd(REBUILD_KEY, batch)
+    pipe.expire(REBUILDING_KEY, REBUILD_TTL)
+    pipe.execute()
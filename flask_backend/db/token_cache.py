@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+In-process cache of recently validated JWTs.
+
+A validated token is trusted for a few seconds without asking Redis
+again. Revocations are published over Redis pub/sub so every process
+drops the revoked user's entries at once; the entries' TTL bounds how
+long a lost message could keep a revoked token alive.
+"""
+from collections import OrderedDict
+from db.redis_client import redis_client as rc
+from threading import Lock
+from time import monotonic
+from typing import Dict, Optional
+
+# Pub/sub channel of the identities whose tokens were revoked
+CHANNEL = 'tokens:revoked'
+
+# Most identities kept in the cache, the least recently used are evicted
+MAX_SIZE = 10000
+
+# Validated tokens by identity: {(token_key, epoch): expiry}
+_entries: 'OrderedDict[str, Dict[tuple, float]]' = OrderedDict()
+_lock = Lock()
+_stats = {'hits': 0, 'misses': 0}
+_listener = None
+
+
+def _drop(message: Dict) -> None:
+    """ Forget the identity of a revocation message """
+    identity = message['data']
+    if isinstance(identity, bytes):
+        identity = identity.decode('utf-8')
+
+    with _lock:
+        _entries.pop(identity, None)
+
+
+def _listen() -> None:
+    """ Start following revocations in a background thread, once """
+    global _listener
+
+    if _listener is None or not _listener.is_alive():
+        pubsub = rc.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CHANNEL: _drop})
+        _listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def lookup(identity: str, token_key: str, epoch: Optional[int]) -> bool:
+    """ Tell if a token was validated recently, counting the lookup as
+    a hit or a miss
+    """
+    with _lock:
+        tokens = _entries.get(identity)
+        expiry = tokens.get((token_key, epoch)) if tokens else None
+
+        if expiry is not None and expiry > monotonic():
+            _entries.move_to_end(identity)
+            _stats['hits'] += 1
+            return True
+
+        _stats['misses'] += 1
+        return False
+
+
+def remember(identity: str, token_key: str, epoch: Optional[int],
+             ttl: float) -> None:
+    """ Trust a validated token for `ttl` seconds """
+    _listen()
+
+    with _lock:
+        tokens = _entries.setdefault(identity, {})
+        tokens[(token_key, epoch)] = monotonic() + ttl
+        _entries.move_to_end(identity)
+
+        while len(_entries) > MAX_SIZE:
+            _entries.popitem(last=False)
+
+
+def revoke(identity: str) -> None:
+    """ Forget a user's tokens in every process """
+    with _lock:
+        _entries.pop(identity, None)
+
+    rc.publish(CHANNEL, identity)
+
+
+def stats() -> Dict[str, float]:
+    """ Return this process' cache size, hits, misses and hit rate """
+    with _lock:
+        hits, misses = _stats['hits'], _stats['misses']
+        size = len(_entries)
+
+    lookups = hits + misses
+
+    return {
+        'size': size,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups else 0.0
+    }
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+"""Background jobs, run by the workers started with:
+    flask --app main run-worker
+"""
+from jobs.queue import enqueue, status, work, work_once
+from jobs import tasks
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Job queue in Redis.
+
+A job is a hash holding its task's name and arguments, its status and
+progress. Queued job ids wait in a list, and a worker moves each one to
+the processing list while running it, and another worker takes it over
+if its progress reports stop for JOB_TIMEOUT. A failed job is retried later
+with a growing delay, until it runs out of attempts.
+"""
+from db.redis_client import redis_client as rc
+from flask import current_app, has_app_context
+from time import time
+from typing import Any, Callable, Dict, Optional
+from uuid import uuid4
+import json
+
+QUEUE_KEY = 'jobs:queue'
+PROCESSING_KEY = 'jobs:processing'
+DELAYED_KEY = 'jobs:delayed'
+
+# Attempts to run a job before it is marked as failed
+MAX_ATTEMPTS = 5
+
+# Seconds before the first retry, doubled at each attempt
+RETRY_DELAY = 10
+
+# Seconds a running job may go without a heartbeat, i.e. without reporting
+# progress, before another worker takes it over
+JOB_TIMEOUT = 600
+
+# Seconds a finished job's status is kept
+FINISHED_JOB_TTL = 7 * 24 * 3600
+
+# The tasks jobs can run, by name
+_tasks: Dict[str, Callable] = {}
+
+# Move the delayed jobs that are due to the queue
+_promote_script = rc.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'LIMIT', 0, 100)
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('LPUSH', KEYS[2], job_id)
+end
+return #due
+""")
+
+
+def _job_key(job_id: str) -> str:
+    """ Return the Redis key of a job """
+    return f'job:{job_id}'
+
+
+def task(name: str) -> Callable:
+    """ Register a function as the task run by the jobs named `name`.
+
+    The function is called with the job's id, to report its progress,
+    and the job's arguments.
+    """
+    def register(func: Callable) -> Callable:
+        _tasks[name] = func
+        return func
+
+    return register
+
+
+def is_eager() -> bool:
+    """ Tell if jobs run right away instead of being queued """
+    return has_app_context() and current_app.config.get('JOBS_EAGER', False)
+
+
+def enqueue(name: str, **kwargs: Any) -> str:
+    """ Queue a job running the task `name` with `kwargs`, and return its
+    id. Jobs run right away when JOBS_EAGER is set.
+    """
+    job_id = uuid4().hex
+    rc.hset(_job_key(job_id), mapping={
+        'name': name,
+        'kwargs': json.dumps(kwargs),
+        'status': 'queued',
+        'attempts': 0,
+        'progress': '{}',
+        'created_at': time()
+    })
+
+    if is_eager():
+        while run(job_id) == 'retrying':
+            pass
+    else:
+        rc.lpush(QUEUE_KEY, job_id)
+
+    return job_id
+
+
+def report_progress(job_id: str, **counts: int) -> None:
+    """ Record the progress of a job, telling it is still alive """
+    rc.hset(_job_key(job_id), mapping={'progress': json.dumps(counts),
+                                       'heartbeat_at': time()})
+
+
+def status(job_id: str) -> Optional[Dict[str, Any]]:
+    """ Return a job's status, attempts, progress and last error, or None
+    if it is unknown
+    """
+    job = rc.hgetall(_job_key(job_id))
+    if not job:
+        return None
+
+    job = {k.decode('utf-8'): v.decode('utf-8') for k, v in job.items()}
+    return {
+        'name': job['name'],
+        'status': job['status'],
+        'attempts': int(job['attempts']),
+        'progress': json.loads(job['progress']),
+        'error': job.get('error')
+    }
+
+
+def run(job_id: str) -> str:
+    """ Run a job and return its new status: done, retrying or failed """
+    key = _job_key(job_id)
+    name, kwargs = rc.hmget(key, 'name', 'kwargs')
+    if name is None:
+        return 'failed'
+
+    attempts = rc.hincrby(key, 'attempts', 1)
+    rc.hset(key, mapping={'status': 'running', 'started_at': time(),
+                          'heartbeat_at': time()})
+
+    try:
+        _tasks[name.decode('utf-8')](job_id, **json.loads(kwargs))
+
+    except Exception as err:
+        if attempts < MAX_ATTEMPTS:
+            new_status = 'retrying'
+            if not is_eager():
+                retry_at = time() + RETRY_DELAY * 2 ** (attempts - 1)
+                rc.zadd(DELAYED_KEY, {job_id: retry_at})
+        else:
+            new_status = 'failed'
+            rc.expire(key, FINISHED_JOB_TTL)
+
+        rc.hset(key, mapping={'status': new_status, 'error': repr(err)})
+        return new_status
+
+    rc.hset(key, 'status', 'done')
+    rc.expire(key, FINISHED_JOB_TTL)
+    return 'done'
+
+
+def _requeue_stalled() -> None:
+    """ Queue again the running jobs without a heartbeat for longer than
+    JOB_TIMEOUT, whose worker most likely died
+    """
+    for job_id in rc.lrange(PROCESSING_KEY, 0, -1):
+        heartbeat_at = rc.hget(_job_key(job_id.decode('utf-8')),
+                               'heartbeat_at')
+        if heartbeat_at and time() - float(heartbeat_at) > JOB_TIMEOUT:
+            if rc.lrem(PROCESSING_KEY, 1, job_id):
+                rc.lpush(QUEUE_KEY, job_id)
+
+
+def work_once(timeout: int = 5) -> Optional[str]:
+    """ Wait up to `timeout` seconds for a job and run it. Return the
+    job's id, or None if there was none.
+    """
+    _promote_script(keys=[DELAYED_KEY, QUEUE_KEY], args=[time()])
+    _requeue_stalled()
+
+    job_id = rc.blmove(QUEUE_KEY, PROCESSING_KEY, timeout, 'RIGHT', 'LEFT')
+    if job_id is None:
+        return None
+
+    run(job_id.decode('utf-8'))
+    rc.lrem(PROCESSING_KEY, 1, job_id)
+
+    return job_id.decode('utf-8')
+
+
+def work() -> None:
+    """ Run the queued jobs, forever """
+    while True:
+        work_once()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+The tasks run by background jobs.
+"""
+from bson import ObjectId
+from db import (
+    activity,
+    db,
+    feed_cache,
+    leaderboard,
+    redis_client as rc,
+    streaks,
+    timeline,
+)
+from jobs.queue import report_progress, task
+from time import perf_counter, sleep
+
+# Seconds a job rests after each batch of writes, for each second the batch
+# took: deleting an account uses Mongo at most half of the time
+THROTTLE = 1.0
+
+
+@task('rename_user')
+def rename_user(job_id: str, user_id: str, old_username: str,
+                new_username: str) -> None:
+    """ Propagate a user's new username to its copies """
+    # Leave the copies to a later rename's job
+    user = db.find_user({'_id': ObjectId(user_id)}, {'username': 1})
+    if not user or user['username'] != new_username:
+        return
+
+    # Move the current streak, unless a new entry already started one
+    old_key = streaks.streak_key(old_username)
+    if rc.exists(old_key):
+        if not rc.renamenx(old_key, streaks.streak_key(new_username)):
+            rc.delete(old_key)
+
+    counts = {}
+    for name, count in db.propagate_username(user_id, old_username,
+                                             new_username):
+        counts[name] = counts.get(name, 0) + count
+        report_progress(job_id, **counts)
+
+    # The username is shown on the user's posts
+    feed_cache.bump()
+
+
+@task('delete_user')
+def delete_user(job_id: str, user_id: str, username: str) -> None:
+    """ Delete the data of a user marked as deleted """
+    counts = {}
+    start = perf_counter()
+    for name, ids in db.purge_user(user_id):
+        counts[name] = counts.get(name, 0) + len(ids)
+        report_progress(job_id, **counts)
+
+        # Withdraw the deleted posts from the public timeline
+        if name == 'posts':
+            timeline.remove_posts(*ids)
+            feed_cache.bump()
+
+        # Let other queries through
+        sleep((perf_counter() - start) * THROTTLE)
+        start = perf_counter()
+
+    # Then, the user's Redis keys
+    rc.delete(streaks.streak_key(username))
+    leaderboard.remove_user(user_id)
+    activity.remove_user(user_id)
+    feed_cache.bump()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""JSON provider encoding the app's responses with orjson
+
+MongoDB documents are encoded as they are read: ObjectIds become their
+hex string and datetimes keep the API's '%Y/%m/%d %H:%M:%S' format, so
+routes don't have to convert them first.
+"""
+from bson import ObjectId
+from datetime import date, datetime
+from decimal import Decimal
+from flask import Response
+from flask.json.provider import JSONProvider
+from typing import Any, Union
+from werkzeug.http import http_date
+import orjson
+
+# The format of datetimes in the API
+DATETIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+def _default(o: Any) -> Any:
+    """Encode the types orjson doesn't, or not in the API's format
+    """
+    if isinstance(o, ObjectId):
+        return str(o)
+
+    if isinstance(o, datetime):
+        # Twice as fast as strftime, for naive datetimes
+        if o.tzinfo is None:
+            return o.isoformat(' ', 'seconds').replace('-', '/')
+        return o.strftime(DATETIME_FORMAT)
+
+    if isinstance(o, date):
+        return http_date(o)
+
+    if isinstance(o, Decimal):
+        return str(o)
+
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON '
+                    'serializable')
+
+
+class OrjsonProvider(JSONProvider):
+    """Encode and decode JSON with orjson
+    """
+
+    # Let _default format datetimes, and accept the integer keys of
+    # flasgger's specs
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        """Encode `obj` as a JSON string
+        """
+        return orjson.dumps(obj, default=_default,
+                            option=self.options).decode('utf-8')
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        """Decode a JSON string or bytes
+        """
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        """Make a JSON response, encoded straight to bytes and indented
+        in debug mode
+        """
+        options = self.options
+        if self._app.debug:
+            options |= orjson.OPT_INDENT_2
+
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=options),
+            mimetype=self.mimetype
+        )
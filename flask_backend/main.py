@@ -4,9 +4,15 @@
 from flask import Flask, jsonify
 from flask_cors import CORS
 from config import Config
-from routes import auth_bp, home_bp, profile_bp, feed_bp
+from commands import register_commands
+from db import db, redis_client
+from db import password_service
+from db.password_service import PasswordServiceBusy
+from json_provider import OrjsonProvider
+from routes import auth_bp, home_bp, profile_bp, feed_bp, leaderboard_bp
 from flask_jwt_extended import JWTManager
 from flasgger import Swagger
+import metrics
 
 
 def create_app(config=Config):
@@ -14,6 +20,9 @@ def create_app(config=Config):
     """
     app = Flask(__name__)
 
+    # Encode JSON with orjson, ObjectIds and datetimes included
+    app.json = OrjsonProvider(app)
+
     # Initialize the JWTManager
     jwt = JWTManager(app)
 
@@ -26,8 +35,8 @@ def create_app(config=Config):
     # Set configuration
     app.config.from_object(config)
 
-    # Set up CORS
-    CORS(app)
+    # Set up CORS, letting clients read the feed's next page cursor
+    CORS(app, expose_headers=['X-Next-Cursor'])
 
     # Disable strict slashes
     app.url_map.strict_slashes = False
@@ -37,6 +46,24 @@ def create_app(config=Config):
     app.register_blueprint(home_bp, url_prefix='/api')
     app.register_blueprint(feed_bp, url_prefix='/api/feed')
     app.register_blueprint(profile_bp, url_prefix='/api/me')
+    app.register_blueprint(leaderboard_bp, url_prefix='/api/leaderboard')
+
+    # Size the password hashing pool
+    password_service.init_app(app)
+
+    # Record the requests' latency and calls, served on /metrics
+    metrics.init_app(app, db, redis_client)
+
+    # Register management commands
+    register_commands(app)
+
+    @app.errorhandler(PasswordServiceBusy)
+    def password_service_busy(error):
+        """Return an error if too many passwords are waiting to be hashed
+        """
+        response = jsonify({'error': 'Too many requests, retry later'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
 
     @jwt.invalid_token_loader
     def unauthorized_response(callback):
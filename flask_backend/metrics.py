@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Prometheus metrics of the app, served on /metrics
+
+Each request's latency and response size are recorded by route, once
+the response is sent for streamed ones, with the MongoDB commands,
+Redis commands and DBStorage methods it ran: their totals and time, and
+their number and time per request, so that a route making many small
+calls stands out. Calls made outside of requests, by jobs and commands,
+are counted under the 'background' endpoint. Only the outermost of
+nested calls of a kind is counted, e.g. find_user_posts and not the
+iter_user_posts it calls.
+
+/metrics is only served if SERVE_METRICS is set.
+
+MongoDB commands slower than SLOW_QUERY_MS are logged with their
+collection, query shape and route, and counted in mongo_slow_queries_total.
+"""
+from flask import Flask, Response, g, has_request_context, request
+from functools import wraps
+import logging
+from threading import local
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from pymongo.monitoring import (
+    CommandFailedEvent,
+    CommandListener,
+    CommandStartedEvent,
+    CommandSucceededEvent,
+)
+from time import perf_counter
+from types import GeneratorType
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Latency of the requests, by route',
+    ['method', 'endpoint', 'status']
+)
+
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes',
+    'Size of the responses\' bodies, by route',
+    ['method', 'endpoint', 'status'],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+)
+
+CALLS = Counter(
+    'backend_calls_total',
+    'MongoDB commands, Redis commands and DBStorage methods called',
+    ['endpoint', 'kind', 'name']
+)
+
+CALLS_TIME = Counter(
+    'backend_call_duration_seconds_total',
+    'Time spent in MongoDB commands, Redis commands and DBStorage methods',
+    ['endpoint', 'kind', 'name']
+)
+
+REQUEST_CALLS = Histogram(
+    'request_backend_calls',
+    'MongoDB commands, Redis commands and DBStorage methods per request',
+    ['endpoint', 'kind'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+)
+
+REQUEST_CALLS_TIME = Histogram(
+    'request_backend_call_duration_seconds',
+    'Time spent per request in MongoDB, Redis and DBStorage methods',
+    ['endpoint', 'kind']
+)
+
+SLOW_QUERIES = Counter(
+    'mongo_slow_queries_total',
+    'MongoDB commands slower than SLOW_QUERY_MS',
+    ['endpoint', 'collection', 'command']
+)
+
+# The kinds of calls accounted
+KINDS = ('mongo', 'redis', 'dbstorage')
+
+# Set once the clients are instrumented, as apps share them
+_installed = False
+
+# Seconds beyond which a MongoDB command is logged (0 disables the log)
+slow_query_seconds = 0.0
+
+logger = logging.getLogger(__name__)
+
+# Depth of the calls being accounted in the current thread, by kind
+_depth = local()
+
+
+def _endpoint() -> str:
+    """Return the route of the current request, or 'background'"""
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
+
+
+def record_call(kind: str, name: str, seconds: float) -> None:
+    """Account a call, in the totals and in the current request's"""
+    endpoint = _endpoint()
+    CALLS.labels(endpoint, kind, name).inc()
+    CALLS_TIME.labels(endpoint, kind, name).inc(seconds)
+
+    if has_request_context() and 'backend_calls' in g:
+        count, total = g.backend_calls[kind]
+        g.backend_calls[kind] = (count + 1, total + seconds)
+
+
+class MongoCommandListener(CommandListener):
+    """Account the MongoDB commands once the metrics are installed, and
+    log the slow ones
+    """
+
+    def __init__(self) -> None:
+        """Keep the running commands, to log them if they are slow"""
+        self._running: Dict[Hashable, Tuple[Dict[str, Any], str]] = {}
+
+    def started(self, event: CommandStartedEvent) -> None:
+        """Keep the command and its route until it ends"""
+        if slow_query_seconds > 0:
+            key = (event.connection_id, event.request_id)
+            self._running[key] = (event.command, _endpoint())
+
+    def _ended(self, event: Any) -> None:
+        """Account a command, and log it if it was slow"""
+        seconds = event.duration_micros / 1e6
+        if _installed:
+            record_call('mongo', event.command_name, seconds)
+
+        started = self._running.pop((event.connection_id, event.request_id),
+                                    None)
+        if started is None or seconds < slow_query_seconds:
+            return
+
+        # Imported here, as the db package imports this module
+        from db.indexes import command_shape
+
+        command, endpoint = started
+        shape = command_shape(event.command_name, command)
+        SLOW_QUERIES.labels(
+            endpoint, shape['collection'], event.command_name
+        ).inc()
+        logger.warning('Slow MongoDB %s on %s from %s: %.0f ms, %s',
+                       event.command_name, shape['collection'], endpoint,
+                       seconds * 1000, shape)
+
+    def succeeded(self, event: CommandSucceededEvent) -> None:
+        """Account a command"""
+        self._ended(event)
+
+    def failed(self, event: CommandFailedEvent) -> None:
+        """Account a failed command"""
+        self._ended(event)
+
+
+# Passed to DBStorage's client
+mongo_listener = MongoCommandListener()
+
+
+def _timed(kind: str, name: str, func: Callable) -> Callable:
+    """Wrap a function to account its calls, and the iteration of the
+    generators it returns
+    """
+    def timed_generator(gen):
+        spent = 0.0
+        try:
+            while True:
+                start = perf_counter()
+                depth = getattr(_depth, kind, 0)
+                setattr(_depth, kind, depth + 1)
+                try:
+                    item = next(gen)
+                finally:
+                    setattr(_depth, kind, depth)
+                    spent += perf_counter() - start
+                yield item
+        except StopIteration:
+            return
+        finally:
+            record_call(kind, name, spent)
+
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        # Calls made by another call are accounted in it
+        if getattr(_depth, kind, 0):
+            return func(*args, **kwargs)
+
+        start = perf_counter()
+        setattr(_depth, kind, 1)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            record_call(kind, name, perf_counter() - start)
+            raise
+        finally:
+            setattr(_depth, kind, 0)
+
+        if isinstance(result, GeneratorType):
+            return timed_generator(result)
+
+        record_call(kind, name, perf_counter() - start)
+        return result
+
+    return wrapper
+
+
+def instrument_storage(storage: Any) -> None:
+    """Account the calls of a DBStorage's public methods"""
+    for name in dir(type(storage)):
+        if not name.startswith('_') and callable(getattr(storage, name)):
+            setattr(storage, name,
+                    _timed('dbstorage', name, getattr(storage, name)))
+
+
+def instrument_redis(client: Any) -> None:
+    """Account the commands a Redis client sends, one at a time or in
+    pipelines"""
+    execute_command = client.execute_command
+
+    @wraps(execute_command)
+    def timed_execute_command(*args: Any, **options: Any) -> Any:
+        start = perf_counter()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            record_call('redis', str(args[0]).upper(),
+                        perf_counter() - start)
+
+    pipeline = client.pipeline
+
+    @wraps(pipeline)
+    def timed_pipeline(*args: Any, **kwargs: Any) -> Any:
+        pipe = pipeline(*args, **kwargs)
+        pipe.execute = _timed('redis', 'PIPELINE', pipe.execute)
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+
+
+def init_app(app: Flask, storage: Any, redis_client: Any) -> None:
+    """Record the app's requests, and serve the metrics on /metrics if
+    SERVE_METRICS is set"""
+    global _installed, slow_query_seconds
+
+    slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+
+    if not _installed:
+        instrument_storage(storage)
+        instrument_redis(redis_client)
+        _installed = True
+
+    @app.before_request
+    def start_accounting():
+        """Start accounting the request's calls"""
+        g.backend_calls = {kind: (0, 0.0) for kind in KINDS}
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        """Record the request's latency, size and calls, when a streamed
+        response is closed"""
+        if 'request_start' not in g:
+            return response
+
+        endpoint = _endpoint()
+        labels = (request.method, endpoint, response.status_code)
+        # Still updated while a streamed response is generated
+        start, calls = g.request_start, g.backend_calls
+
+        def record(size: int) -> None:
+            REQUEST_LATENCY.labels(*labels).observe(perf_counter() - start)
+            RESPONSE_SIZE.labels(*labels).observe(size)
+
+            for kind, (count, seconds) in calls.items():
+                REQUEST_CALLS.labels(endpoint, kind).observe(count)
+                REQUEST_CALLS_TIME.labels(endpoint, kind).observe(seconds)
+
+        if not response.is_streamed:
+            record(response.calculate_content_length() or 0)
+            return response
+
+        sent = 0
+
+        def counted(chunks):
+            nonlocal sent
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    sent += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        response.response = counted(response.response)
+        response.call_on_close(lambda: record(sent))
+        return response
+
+    if not app.config['SERVE_METRICS']:
+        return
+
+    @app.route('/metrics')
+    def metrics():
+        """Serve the metrics in Prometheus' text format"""
+        return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
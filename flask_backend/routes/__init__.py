@@ -3,3 +3,4 @@ from routes.auth import auth_bp
 from routes.home import home_bp
 from routes.profile import profile_bp
 from routes.feed import feed_bp
+from routes.leaderboard import leaderboard_bp
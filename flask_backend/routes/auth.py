@@ -1,18 +1,23 @@
 #!/usr/bin/env python3
 """The routes for the Authentication management
 """
-from flask import Blueprint, jsonify, request, current_app
+from bson import ObjectId
+from flask import Blueprint, g, jsonify, request, current_app
 from datetime import datetime
-from db import db, redis_client as rc
+from db import db, redis_client as rc, token_cache
 from functools import wraps
-import bcrypt
+from time import perf_counter
 from flask_jwt_extended import (
     create_access_token,
     jwt_required,
+    get_jwt,
     get_jwt_identity,
     create_refresh_token,
 )
 from flasgger.utils import swag_from
+from pymongo.errors import DuplicateKeyError
+from typing import Dict
+from werkzeug.local import LocalProxy
 
 
 # Create auth Blueprint
@@ -25,23 +30,108 @@ def store_token(token_key, token, ttl_seconds):
     rc.setex(token_key, ttl_seconds, token)
 
 
-def is_token_expired(token_key):
-    """Check if a JWT is stored and alive in Redis
+def is_token_valid(token_key, identity):
+    """Check if a JWT is stored and alive in Redis, and was issued since
+    the last change of its user's claims
     """
-    return rc.exists(token_key)
+    claims = get_jwt()
+    cache_ttl = current_app.config['TOKEN_CACHE_TTL']
+
+    # Trust the tokens validated in the last seconds
+    if cache_ttl and token_cache.lookup(identity, token_key,
+                                        claims.get('epoch')):
+        return True
+
+    pipe = rc.pipeline()
+    pipe.exists(token_key)
+    pipe.get(identity + '_epoch')
+    alive, epoch = pipe.execute()
+
+    # Tokens created without claims only rely on their presence in Redis
+    if 'epoch' in claims and claims['epoch'] != int(epoch or 0):
+        return False
+
+    if alive and cache_ttl:
+        token_cache.remember(identity, token_key, claims.get('epoch'),
+                             cache_ttl)
+
+    return bool(alive)
+
+
+def revoke_tokens(identity):
+    """Delete a user's JWTs from Redis, and from every process' cache
+    """
+    rc.delete(identity, identity + '_refresh')
+    token_cache.revoke(identity)
+
+
+def token_claims(user: Dict) -> Dict:
+    """Return the additional claims of a user's JWTs
+    """
+    return {'username': user['username'],
+            'epoch': user.get('token_epoch', 0)}
+
+
+def issue_tokens(user_id: str, claims: Dict) -> Dict[str, str]:
+    """Create and store a user's JWT Access and Refresh tokens
+    """
+    access_token = create_access_token(identity=user_id,
+                                       additional_claims=claims)
+    refresh_token = create_refresh_token(identity=user_id,
+                                         additional_claims=claims)
+
+    # Store both JWTs, and the epoch they were issued at
+    store_token(user_id, access_token,
+                current_app.config["JWT_ACCESS_TOKEN_EXPIRES"])
+    store_token(user_id + "_refresh", refresh_token,
+                current_app.config["JWT_REFRESH_TOKEN_EXPIRES"])
+    rc.set(user_id + '_epoch', claims['epoch'])
+
+    return {'access_token': access_token, 'refresh_token': refresh_token}
+
+
+# The fields of the current user the handlers need
+CURRENT_USER_FIELDS = {'username': 1, 'email': 1, 'longest_streak': 1}
+
+
+def load_current_user():
+    """Return the authenticated user's document, fetching it from MongoDB
+    the first time it is needed in the request
+    """
+    if 'current_user' not in g:
+        g.current_user = db.find_user(
+            {'_id': ObjectId(g.current_user_id)},
+            CURRENT_USER_FIELDS
+        )
+
+    return g.current_user
+
+
+# The authenticated user of the request, loaded lazily
+current_user = LocalProxy(load_current_user)
+
+
+def current_username():
+    """Return the username of the request's user, from its JWT's claims
+    when present
+    """
+    return get_jwt().get('username') or current_user['username']
 
 
 def verify_token_in_redis(func):
-    """Decorator to ensure a JWT presence
+    """Decorator to ensure a JWT presence, and to bind the request's
+    current_user to its identity
     """
 
     @wraps(func)
     def valid_token(*args, **kwargs):
         identity = get_jwt_identity()
 
-        if not is_token_expired(identity):
+        if not is_token_valid(identity, identity):
             return jsonify({"error": "Token has been revoked"}), 401
 
+        g.current_user_id = identity
+
         return func(*args, **kwargs)
 
     return valid_token
@@ -71,23 +161,22 @@ def register():
     if not password:
         return jsonify({'error': 'Missing password'}), 400
 
-    # Ensure email is not already used
-    if db.find_user({'email': email}):
-        return jsonify({'error': 'Email already used'}), 400
-
-    # Ensure username is not already used
-    if db.find_user({'username': username}):
-        return jsonify({'error': 'Username already used'}), 400
-
     # Insert user to db
     doc = {
         'email': email,
         'username': username,
         'password': password,
         'created_at': datetime.utcnow(),
-        'longest_streak': 0
+        'longest_streak': 0,
+        'token_epoch': 0
     }
-    db.insert_user(doc)
+
+    # Unique indexes ensure the email and username are not already used
+    try:
+        db.insert_user(doc)
+    except DuplicateKeyError as err:
+        field = db.duplicate_user_field(err, doc)
+        return jsonify({'error': f'{field.capitalize()} already used'}), 400
 
     # Return respose
     return jsonify({'Created user': username, 'email': email}), 201
@@ -110,47 +199,24 @@ def login():
     if not password:
         return jsonify({'error': 'Missing password'}), 400
 
-    # Get the user
-    user_from_db = db.find_user({'email': email})
-
-    if user_from_db:
-
-        # Check that the password is correct
-        hashed_password = db.get_hash(email)
-        verified = bcrypt.checkpw(password.encode('utf-8'), hashed_password)
-        if verified:
-
-            # Create JWT Access Token
-            access_token = create_access_token(
-                identity=str(user_from_db['_id'])
-            )
-
-            # Create JWT Refresh Token
-            refresh_token = create_refresh_token(
-                identity=str(user_from_db['_id'])
-            )
-
-            # Store JWT Access Token
-            store_token(
-                str(user_from_db['_id']),
-                access_token,
-                current_app.config["JWT_ACCESS_TOKEN_EXPIRES"]
-            )
-
-            # Store JWT Refresh Token
-            store_token(
-                str(user_from_db['_id']) + "_refresh",
-                refresh_token,
-                current_app.config["JWT_REFRESH_TOKEN_EXPIRES"]
-            )
-
-            # Return both JWTs as a response
-            return jsonify(
-                {
-                    'access_token': access_token,
-                    'refresh_token': refresh_token
-                }
-            ), 200
+    # Get the user, if the credentials are correct
+    timings = {}
+    user = db.authenticate(email, password, timings)
+
+    if user:
+
+        # Create and store JWT Access and Refresh Tokens
+        start = perf_counter()
+        tokens = issue_tokens(user['_id'], token_claims(user))
+        timings['token'] = perf_counter() - start
+
+        # Return both JWTs as a response, with the time spent on each stage
+        response = jsonify(tokens)
+        response.headers['Server-Timing'] = ', '.join(
+            f'{stage};dur={seconds * 1000:.1f}'
+            for stage, seconds in timings.items()
+        )
+        return response, 200
 
     # Return an error if credentials were wrong
     return jsonify({'error': 'The email and/or password are incorrect'}), 401
@@ -168,11 +234,14 @@ def refresh():
 
     # Check JWT Refresh token
     key = current_user + '_refresh'
-    if not is_token_expired(key):
+    if not is_token_valid(key, current_user):
         return jsonify({"error": "Token has been revoked"}), 401
 
-    # Create and store a new JWT Access token
-    new_access_token = create_access_token(identity=current_user)
+    # Create and store a new JWT Access token, with the same claims
+    claims = {k: v for k, v in get_jwt().items()
+              if k in ('username', 'epoch')}
+    new_access_token = create_access_token(identity=current_user,
+                                           additional_claims=claims)
 
     store_token(
         current_user,
@@ -192,7 +261,6 @@ def logout():
     """Invalidate JWTs by deleting them from Redis
     """
     current_user = get_jwt_identity()
-    rc.delete(current_user)
-    rc.delete(current_user + "_refresh")
+    revoke_tokens(current_user)
 
     return jsonify({}), 204
@@ -1,24 +1,131 @@
 #!/usr/bin/env python3
 """ Feed routes """
-from flask import Blueprint, jsonify, request
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from flask import Blueprint, Response, current_app, jsonify, request
 from datetime import datetime
-from db import db
+from db import db, feed_cache, timeline
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from routes.auth import verify_token_in_redis
-from typing import Dict
+from routes.auth import current_username, verify_token_in_redis
+from routes.streaming import ndjson_response, wants_stream
+from typing import Dict, Iterator, List, Optional, Tuple
 from bson import ObjectId
+from bson.errors import InvalidId
 from flasgger import swag_from
 
 # Create feed Blueprint
 feed_bp = Blueprint('feed_bp', __name__)
 
+# Number of posts in a feed page
+FEED_PAGE_SIZE = 20
 
-def serialize_comment(comment: Dict) -> Dict:
-    """Serialize a comment
+# Maximum number of comments in a page of a post's comments
+COMMENTS_PAGE_SIZE = 50
+
+# Number of streamed posts whose likes are looked up at once
+STREAM_BATCH_SIZE = 100
+
+
+def encode_cursor(post: Dict) -> str:
+    """Make an opaque feed cursor from a post's datePosted and _id
+    """
+    raw = f"{post['datePosted'].isoformat()},{post['_id']}"
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Return the (datePosted, _id) keyset hidden in a feed cursor
+    """
+    raw = urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+    date_posted, post_id = raw.split(',')
+    return datetime.fromisoformat(date_posted), ObjectId(post_id)
+
+
+def fetch_feed_page(
+        skip: int = 0,
+        after: Optional[Tuple[datetime, ObjectId]] = None
+) -> List[Dict]:
+    """Return a page of the feed, read from the precomputed timeline
+    when it is built, or else from MongoDB
+    """
+    if after is None:
+        post_ids = timeline.page(skip, FEED_PAGE_SIZE)
+    else:
+        date_posted, post_id = after
+        post_ids = timeline.page_after(post_id, date_posted, FEED_PAGE_SIZE)
+
+    if post_ids is None:
+        return db.find_feed_posts(limit=FEED_PAGE_SIZE, skip=skip, after=after)
+
+    return db.find_posts_by_ids(post_ids)
+
+
+def flag_liked_posts(posts: List[Dict], user_id: str) -> List[Dict]:
+    """Flag the posts liked by a user, with one lookup for all of them
+    """
+    liked = db.liked_post_ids(user_id, [p['_id'] for p in posts])
+    for p in posts:
+        p['liked_by_me'] = p['_id'] in liked
+    return posts
+
+
+def iter_flagged_feed(user_id: str) -> Iterator[Dict]:
+    """Yield all the feed's posts, flagging those liked by a user batch
+    by batch
+    """
+    batch = []
+    for post in db.iter_feed_posts():
+        batch.append(post)
+        if len(batch) == STREAM_BATCH_SIZE:
+            yield from flag_liked_posts(batch, user_id)
+            batch = []
+
+    yield from flag_liked_posts(batch, user_id)
+
+
+def feed_response(posts: List[Dict], next_cursor: str) -> Response:
+    """Make the response of a feed page, flagging the posts liked by the
+    current user
+    """
+    flag_liked_posts(posts, get_jwt_identity())
+
+    response = jsonify(posts)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+
+    return response
+
+
+def encode_feed_page(posts: List[Dict], next_cursor: str) -> bytes:
+    """Encode a feed page as seen by everyone, to be cached: its next
+    cursor, then each post's id and JSON object on its own line
     """
-    comment['post_id'] = str(comment['post_id'])
-    comment['user_id'] = str(comment['user_id'])
-    return comment
+    lines = [next_cursor.encode('utf-8')]
+    for p in posts:
+        lines.append(str(p['_id']).encode('utf-8') + b' ' +
+                     current_app.json.dumps(p).encode('utf-8'))
+
+    return b'\n'.join(lines)
+
+
+def cached_feed_response(page: bytes) -> Response:
+    """Make the response of an encoded feed page, flagging the posts
+    liked by the current user in their JSON objects without decoding them
+    """
+    next_cursor, *lines = page.split(b'\n')
+    posts = [line.decode('utf-8').split(' ', 1) for line in lines]
+
+    liked = db.liked_post_ids(get_jwt_identity(), [i for i, _ in posts])
+    body = '[' + ','.join(
+        post[:-1] + (',"liked_by_me":true}' if post_id in liked
+                     else ',"liked_by_me":false}')
+        for post_id, post in posts
+    ) + ']'
+
+    response = current_app.response_class(body, mimetype='application/json')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor.decode('utf-8')
+
+    return response
 
 
 @feed_bp.route('/get_posts', methods=['GET'])
@@ -27,44 +134,73 @@ def serialize_comment(comment: Dict) -> Dict:
 @swag_from('../documentation/feed/get_feed.yml')
 def get_feed():
     """ Return all the public posts """
-    posts = list(filter(lambda p: p['is_public'] is True, db.find_all_posts()))
+    page = request.args.get('page')
+    after = request.args.get('after')
 
-    # Sort posts from the most to the less recent
-    posts.sort(key=lambda x: x['datePosted'], reverse=True)
+    # If a cursor is given, return the page of posts following it
+    if after:
+        try:
+            cursor = decode_cursor(after)
+        except (ValueError, InvalidId):
+            return jsonify({'error': 'invalid after cursor'}), 400
 
-    # Stringify datePosted
-    for p in posts:
-        p['datePosted'] = p['datePosted'].strftime('%Y/%m/%d %H:%M:%S')
-        for i in range(len(p['comments'])):
-            p['comments'][i] = serialize_comment(p['comments'][i])
+        cache_name = f'after:{after}'
 
     # If a page is queried, paginate with 20 posts per page
-    page = request.args.get('page')
-    if page:
+    elif page:
         try:
             page_num = int(page)
-
-            if page_num < 1:
-                return jsonify(
-                    {
-                        'error': 'page number must be greater or equal to 1'
-                    }
-                ), 400
-
-            # Compute posts quantity
-            len_posts = len(posts)
-
-            # Extract the page
-            if (page_num - 1) * 20 > len_posts:
-                return jsonify({'info': 'page out of range'})
-
-            return jsonify(posts[(page_num - 1) * 20: page_num * 20])
-
         except ValueError:
             return jsonify({'error': 'page argument must be an integer'}), 400
 
+        if page_num < 1:
+            return jsonify(
+                {
+                    'error': 'page number must be greater or equal to 1'
+                }
+            ), 400
+
+        cache_name = f'page:{page_num}'
+
     else:  # Return all posts with no pagination
-        return jsonify(posts)
+        cache_name = 'all'
+
+        # Stream them as they are read if asked to
+        if wants_stream():
+            return ndjson_response(iter_flagged_feed(get_jwt_identity()))
+
+    # Serve the page as cached if no write happened since
+    cache_ttl = current_app.config['FEED_CACHE_TTL']
+    if cache_ttl:
+        version, cached = feed_cache.lookup(cache_name)
+        if cached is not None:
+            return cached_feed_response(cached)
+
+    if after:
+        posts = fetch_feed_page(after=cursor)
+    elif page:
+        skip = (page_num - 1) * FEED_PAGE_SIZE
+        posts = fetch_feed_page(skip=skip)
+
+        # The page following the last full one is empty, the next ones
+        # are out of range
+        if not posts and page_num > 1 and not fetch_feed_page(skip=skip - 1):
+            return jsonify({'info': 'page out of range'})
+    else:
+        posts = db.find_feed_posts()
+
+    # A full page may be followed by another one
+    next_cursor = ''
+    if (after or page) and len(posts) == FEED_PAGE_SIZE:
+        next_cursor = encode_cursor(posts[-1])
+
+    # Cache the page as seen by everyone, before flagging the user's likes
+    if cache_ttl:
+        cached = encode_feed_page(posts, next_cursor)
+        feed_cache.store(version, cache_name, cached, cache_ttl)
+        return cached_feed_response(cached)
+
+    return feed_response(posts, next_cursor)
 
 
 @feed_bp.route('/like', methods=['POST'])
@@ -86,21 +222,17 @@ def like():
     if not post_id:
         return jsonify({"error": "Missing post_id"}), 400
 
-    # Return the post associated with post_id
-    post = db.find_post({"_id": ObjectId(post_id)})
+    # Like the post if it exists and is not liked by the user yet
+    res_code = db.like_post(user_id, post_id)
 
-    # Check if the post exist.
-    if post:
-
-        # Check if the post is already liked by the current user
-        liked = db.like_post(user_id, post['_id'])
+    if res_code == -1:
+        return jsonify({"error": "Post not found."}), 404
 
-        if liked:
-            return jsonify({"error": "User has already liked the post."}), 400
+    if res_code == -2:
+        return jsonify({"error": "User has already liked the post."}), 400
 
-        return jsonify({"success": "Post liked successfully."}), 201
-
-    return jsonify({"error": "Post not found."}), 404
+    feed_cache.bump()
+    return jsonify({"success": "Post liked successfully."}), 201
 
 
 @feed_bp.route('/unlike', methods=['POST'])
@@ -122,22 +254,19 @@ def unlike():
     if not post_id:
         return jsonify({"error": "Missing post_id"}), 400
 
-    # Return the post associated with post_id
-    post = db.find_post({"_id": ObjectId(post_id)})
+    # Unlike the post if it exists and is liked by the user
+    res_code = db.unlike_post(user_id, post_id)
 
-    # Check if the post exist.
-    if post:
-        unliked = db.unlike_post(user_id, post['_id'])
+    if res_code == -1:
+        return jsonify({"error": "Post not found."}), 404
 
-        # Check if the post is already unliked by the current user
-        if unliked:
-            return jsonify(
-                {"error": "User can only unliked the post that he liked."}
-            ), 400
-
-        return jsonify({"success": "Post unliked successfully."}), 200
+    if res_code == -2:
+        return jsonify(
+            {"error": "User can only unliked the post that he liked."}
+        ), 400
 
-    return jsonify({"error": "Post not found."}), 404
+    feed_cache.bump()
+    return jsonify({"success": "Post unliked successfully."}), 200
 
 
 @feed_bp.route('/comment', methods=['POST'])
@@ -154,7 +283,7 @@ def comment():
 
     # Get the current user
     user_id = get_jwt_identity()
-    user = db.find_user({"_id": ObjectId(user_id)})
+    username = current_username()
 
     # comment body
     comment_body = data.get('body')
@@ -170,7 +299,7 @@ def comment():
     if post:
         comment_document = {
             'user_id': ObjectId(user_id),
-            'username': user['username'],
+            'username': username,
             'post_id': ObjectId(post_id),
             'body': comment_body,
             'date_posted': datetime.utcnow().strftime(
@@ -179,12 +308,13 @@ def comment():
         }
 
         comment_id = db.insert_comment(comment_document, post_id)
-        comment = db.find_comment(comment_id, user['username'])
+        comment = db.find_comment(comment_id, username)
 
         if comment_id:
+            feed_cache.bump()
             return jsonify(
                 {
-                    'data': serialize_comment(comment),
+                    'data': comment,
                     "msg": "Comment created successfully."
                 }
             ), 201
@@ -205,8 +335,7 @@ def update_comment():
     post_id = data.get('post_id')
 
     # Get the current user
-    user_id = get_jwt_identity()
-    user = db.find_user({"_id": ObjectId(user_id)})
+    username = current_username()
 
     # comment id
     comment_id = data.get('comment_id')
@@ -231,11 +360,12 @@ def update_comment():
     if post:
 
         updated_comment = db.update_comment(
-            comment_id, user['username'], comment_body)
+            comment_id, username, comment_body)
         if updated_comment:
+            feed_cache.bump()
             return jsonify(
                 {
-                    'data': serialize_comment(updated_comment),
+                    'data': updated_comment,
                     "msg": "Comment updated successfully."
                 }
             ), 200
@@ -256,8 +386,7 @@ def delete_comment():
     post_id = data.get('post_id')
 
     # Get the current user
-    user_id = get_jwt_identity()
-    user = db.find_user({"_id": ObjectId(user_id)})
+    username = current_username()
 
     # comment id
     comment_id = data.get('comment_id')
@@ -276,9 +405,10 @@ def delete_comment():
     # Check if the post exist.
     if post:
 
-        deleted = db.delete_comment(comment_id, user['username'], post_id)
+        deleted = db.delete_comment(comment_id, username, post_id)
 
         if deleted:
+            feed_cache.bump()
             return jsonify({"msg": "Comment deleted successfully."}), 200
 
     return jsonify({"error": "Post not found."}), 404
@@ -289,7 +419,7 @@ def delete_comment():
 @verify_token_in_redis
 @swag_from('../documentation/feed/post_comments.yml')
 def post_comments():
-    """ route for returing all the comments associated with a post """
+    """ route for returing a page of the comments associated with a post """
     # Get data from request
     data = request.get_json()
 
@@ -300,6 +430,18 @@ def post_comments():
     if not post_id:
         return jsonify({"error": "Missing post_id"}), 400
 
+    # Get the id of the comment the page starts after
+    after = data.get('after')
+    if after is not None and not ObjectId.is_valid(after):
+        return jsonify({"error": "after must be a comment_id"}), 400
+
+    # Get the page size
+    limit = data.get('limit', COMMENTS_PAGE_SIZE)
+    if type(limit) is not int or not 1 <= limit <= COMMENTS_PAGE_SIZE:
+        return jsonify(
+            {"error": f"limit must be between 1 and {COMMENTS_PAGE_SIZE}"}
+        ), 400
+
     # Return the post associated with post_id
     post = db.find_post({"_id": ObjectId(post_id)})
 
@@ -307,17 +449,17 @@ def post_comments():
     if post:
 
         # Get comments from db
-        comments = db.get_post_comments(post_id)
-
-        for i in range(len(comments)):
-            comments[i] = serialize_comment(comments[i])
-
-        if comments:
-            return jsonify(
-                {
-                    'data': comments,
-                    "msg": "Comments retrieved successfully."
-                }
-            ), 200
+        comments = db.get_post_comments(post_id, after=after, limit=limit)
+
+        # A full page may be followed by another one
+        next_cursor = comments[-1]['_id'] if len(comments) == limit else None
+
+        return jsonify(
+            {
+                'data': comments,
+                'next': next_cursor,
+                "msg": "Comments retrieved successfully."
+            }
+        ), 200
 
     return jsonify({"error": "Post not found."}), 404
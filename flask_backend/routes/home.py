@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 """The Home page routes
 """
-from bson import ObjectId
 from datetime import datetime
+from db import (
+    activity,
+    db,
+    feed_cache,
+    leaderboard,
+    streaks,
+    timeline,
+    token_cache,
+)
+from flask import Blueprint, current_app, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from routes.auth import verify_token_in_redis
-from db import db, redis_client as rc
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from routes.auth import verify_token_in_redis
-import os
+from routes.auth import current_username, verify_token_in_redis
 from flasgger import swag_from
 
 # Create home Blueprint
@@ -25,9 +29,9 @@ def home():
 
     # Get the user
     user_id = get_jwt_identity()
-    user = db.find_user({'_id': ObjectId(user_id)})
-    if user:
-        return jsonify({'user_id': user_id, 'username': user['username']}), 200
+    username = current_username()
+    if username:
+        return jsonify({'user_id': user_id, 'username': username}), 200
 
 
 @home_bp.route('/log', methods=['POST'])
@@ -40,31 +44,7 @@ def log():
 
     # Get the user
     user_id = get_jwt_identity()
-    user = db.find_user({'_id': ObjectId(user_id)})
-
-    # First, only allow one post in a 20h interval
-
-    # Current streak key in Redis
-    cs_key = f"{user['username']}_CS"
-
-    # Define 20h as the minimum interval between two entries (0 < ttl < 8h),
-    # or 1 minute for development, or 2 seconds for testing
-    if os.getenv('MODE') == 'DEV':
-        max_allowed_ttl = 60
-    elif os.getenv('MODE') == 'TEST':
-        max_allowed_ttl = 2
-    else:
-        max_allowed_ttl = 8 * 3600
-
-    # Check current streak
-    current_streak = rc.get(cs_key)
-    if not current_streak:
-        current_streak = 0
-    elif rc.ttl(cs_key) > max_allowed_ttl:
-        return jsonify({'error': 'Only one post per day is allowed',
-                        'ttl': rc.ttl(cs_key) - max_allowed_ttl}), 400
-    else:
-        current_streak = int(current_streak.decode('utf-8'))
+    username = current_username()
 
     # Get data
     data = request.get_json()
@@ -72,13 +52,13 @@ def log():
     # Retrieve the entry's infos
     entry = {
         'user_id': user_id,
-        'username': user['username'],
+        'username': username,
         'title': data.get('title'),
         'content': data.get('content'),
         'is_public': data.get('is_public', False),
-        'likes': [],
         'number_of_likes': 0,
         'comments': [],
+        'number_of_comments': 0,
         'datePosted': datetime.utcnow()
     }
 
@@ -89,42 +69,54 @@ def log():
     elif type(entry['is_public']) is not bool:
         return jsonify({'error': '`is_public` must be true or false'}), 400
 
+    # Only allow one post per day, extending the user's current streak
+    ttl = current_app.config['STREAK_TTL']
+    interval = current_app.config['STREAK_INTERVAL']
+    new_current_streak, wait = streaks.log_entry(username, ttl, interval)
+
+    if new_current_streak is None:
+        # Seed the streak missing from the cache from MongoDB
+        seed = streaks.alive_streak(db.find_streak(user_id), ttl)
+        new_current_streak, wait = streaks.log_entry(username, ttl,
+                                                     interval, seed)
+
+    if wait:
+        return jsonify({'error': 'Only one post per day is allowed',
+                        'ttl': wait}), 400
+
     # Store this log in MongoDB
     db.insert_post(entry)
+    activity.add_entry(user_id, entry['datePosted'])
+
+    # Publish it on the public timeline
+    if entry['is_public']:
+        timeline.add_post(entry['_id'], entry['datePosted'])
+        feed_cache.bump()
 
     # Make response
     response = entry.copy()
-    response['_id'] = str(response['_id'])
-    response['user_id'] = str(response['user_id'])
     del response['number_of_likes']
-    del response['likes']
+    del response['number_of_comments']
     del response['comments']
 
-    time_fmt = '%Y/%m/%d %H:%M:%S'
-    response['datePosted'] = response['datePosted'].strftime(time_fmt)
-
-    # Response will return if the user marks a new longest streak
-    response['new_record'] = False
+    # Store the new streak durably
+    db.record_streak_entry(user_id, new_current_streak, entry['datePosted'])
+    leaderboard.record(user_id, username, new_current_streak, ttl)
 
-    # Reset user's current streak key in Redis for 28h,
-    # or 2 minutes for development, or 4 seconds for testing
-    new_current_streak = current_streak + 1
-    if os.getenv('MODE') == 'DEV':
-        rc.setex(cs_key, 120, new_current_streak)
-    elif os.getenv('MODE') == 'TEST':
-        rc.setex(cs_key, 4, new_current_streak)
-    else:
-        rc.setex(cs_key, 28 * 3600, new_current_streak)
-
-    # Update user's longest streak if applicable
-    new_longest_streak = user['longest_streak']
-    if new_current_streak > new_longest_streak:
-        new_longest_streak = new_current_streak
-        response['new_record'] = True
-
-    db.update_user_info(user_id, {
-        'longest_streak': new_longest_streak
-    })
+    # Update user's longest streak if applicable, and tell if it was
+    response['new_record'] = db.raise_longest_streak(user_id,
+                                                     new_current_streak)
 
     # Return response
     return jsonify(response), 201
+
+
+@home_bp.route('/stats')
+@jwt_required()
+@verify_token_in_redis
+@swag_from('../documentation/home/stats.yml')
+def stats():
+    """Get the caches' statistics
+    """
+    return jsonify({'feed_cache': feed_cache.stats(),
+                    'token_cache': token_cache.stats()}), 200
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""The streak leaderboard routes
+"""
+from db import leaderboard
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from routes.auth import verify_token_in_redis
+from flasgger import swag_from
+
+# Create leaderboard Blueprint
+leaderboard_bp = Blueprint('leaderboard_bp', __name__)
+
+# Default and maximum number of users in the top of a leaderboard
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_SIZE = 100
+
+
+@leaderboard_bp.route('/')
+@jwt_required()
+@verify_token_in_redis
+@swag_from('../documentation/leaderboard/get_leaderboard.yml')
+def get_leaderboard():
+    """Get the top users of a streak leaderboard, and the user's rank
+    """
+
+    # Get the board: longest or current streaks
+    board = request.args.get('board', 'longest')
+    if board not in leaderboard.BOARDS:
+        return jsonify({'error': '`board` must be longest or current'}), 400
+
+    # Get the number of users to return
+    try:
+        limit = int(request.args.get('limit', LEADERBOARD_SIZE))
+    except ValueError:
+        return jsonify({'error': '`limit` must be an integer'}), 400
+
+    if not 1 <= limit <= MAX_LEADERBOARD_SIZE:
+        return jsonify({'error': '`limit` must be between 1 and '
+                        f'{MAX_LEADERBOARD_SIZE}'}), 400
+
+    # Get the standings
+    top, me = leaderboard.standings(board, limit, get_jwt_identity())
+
+    return jsonify({'board': board, 'top': top, 'me': me}), 200
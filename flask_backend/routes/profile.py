@@ -2,17 +2,37 @@
 """The routes for the user space management
 """
 from bson import ObjectId
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, current_app, jsonify, request
 from datetime import datetime
-from db import db, redis_client as rc
+from db import (
+    activity,
+    db,
+    feed_cache,
+    leaderboard,
+    streaks,
+    timeline,
+    token_cache,
+)
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from routes.auth import verify_token_in_redis
-from routes.feed import serialize_comment
+from pymongo.errors import DuplicateKeyError
+from routes.auth import (
+    current_user,
+    current_username,
+    issue_tokens,
+    revoke_tokens,
+    verify_token_in_redis,
+)
+from routes.streaming import ndjson_response, wants_stream
 from flasgger import swag_from
+import jobs
 
 # Create profile Blueprint
 profile_bp = Blueprint('profile_bp', __name__)
 
+# The fields of a user's posts returned to their author
+OWN_POST_PROJECTION = {'_id': 0, 'user_id': 0}
+
+
 # FIND (GET) ROUTES
 
 
@@ -25,8 +45,7 @@ def get_infos():
     """
 
     # Get the user
-    user_id = get_jwt_identity()
-    user = db.find_user({'_id': ObjectId(user_id)})
+    user = current_user
 
     # Return response
     response = {'email': user['email'], 'username': user['username']}
@@ -42,22 +61,22 @@ def get_streaks():
     """
 
     # Get the user
-    user_id = get_jwt_identity()
-    user = db.find_user({'_id': ObjectId(user_id)})
+    user = current_user
 
     # Get longest streak
     longest_streak = user['longest_streak']
 
-    # Get current streak
-    cs_key = user['username'] + '_CS'
-    current_streak = rc.get(cs_key)
+    # Get current streak, from MongoDB if it is not cached
+    cached = streaks.cached_streak(current_username())
 
-    if not current_streak:
-        current_streak = 0
-        ttl = 0
+    if cached:
+        current_streak, ttl = cached
     else:
-        current_streak = int(current_streak.decode('utf-8'))
-        ttl = rc.ttl(cs_key)
+        current_streak, ttl = streaks.alive_streak(
+            db.find_streak(get_jwt_identity()),
+            current_app.config['STREAK_TTL']
+        )
+        ttl //= 1000
 
     # Return response
     response = {'longest_streak': longest_streak,
@@ -78,20 +97,38 @@ def get_posts():
     # Get the user_id
     user_id = get_jwt_identity()
 
-    # Return posts
-    posts = db.find_user_posts(user_id)
+    # Get posts, from the most to the less recent
+    posts = db.iter_user_posts(user_id, projection=OWN_POST_PROJECTION)
+
+    # Stream posts as they are read if asked to
+    if wants_stream():
+        return ndjson_response(posts)
+
+    return jsonify(list(posts))
 
-    # Sort posts from the most to the less recent
-    posts.sort(key=lambda x: x['datePosted'], reverse=True)
 
-    for p in posts:
-        del p['_id']
-        del p['user_id']
-        p['datePosted'] = p['datePosted'].strftime('%Y/%m/%d %H:%M:%S')
-        for i in range(len(p['comments'])):
-            p['comments'][i] = serialize_comment(p['comments'][i])
+@profile_bp.route('/activity')
+@jwt_required()
+@verify_token_in_redis
+@swag_from('../documentation/profile/get_activity.yml')
+def get_activity():
+    """Get the user's number of entries on each day of a year
+    """
+
+    # Get the user_id
+    user_id = get_jwt_identity()
 
-    return jsonify(posts)
+    # Get the year, the current one by default
+    try:
+        year = int(request.args.get('year', datetime.utcnow().year))
+    except ValueError:
+        return jsonify({'error': '`year` must be an integer'}), 400
+
+    # Get the daily counts
+    days = activity.year_counts(user_id, year)
+
+    return jsonify({'year': year, 'days': days,
+                    'total': sum(days.values())}), 200
 
 # UPDATE (PUT) ROUTES
 
@@ -140,6 +177,16 @@ def update_post():
                       'content': content, 'is_public': is_public}
     db.update_post(post_id, user_id, updated_fields)
 
+    # Publish or withdraw the post from the public timeline
+    if is_public != post['is_public']:
+        if is_public:
+            timeline.add_post(post_id, post['datePosted'])
+        else:
+            timeline.remove_posts(post_id)
+
+    if is_public or post['is_public']:
+        feed_cache.bump()
+
     # Return response
     return jsonify({'success': 'post updated'}), 201
 
@@ -164,11 +211,35 @@ def update_infos():
         if field not in accepted_fields:
             return jsonify({'error': 'Only update email and/or username'}), 400
 
-    # Update the user's infos
-    db.update_user_info(user_id, data)
+    # Update the user's infos, unless the email or username is used
+    old_username = current_user['username']
+    try:
+        user = db.update_user_info(user_id, data)
+    except DuplicateKeyError as err:
+        field = db.duplicate_user_field(err, data)
+        return jsonify({'error': f'{field.capitalize()} already used'}), 400
+
+    if user is None:
+        return jsonify({'error': 'something went wrong'}), 500
+
+    response = {'success': 'user updated'}
+
+    if user['username'] != old_username:
+        # Update the username's copies in the background
+        response['job_id'] = jobs.enqueue('rename_user',
+                                          user_id=user_id,
+                                          old_username=old_username,
+                                          new_username=user['username'])
+
+        # Revoke the JWTs carrying the old username, and issue new ones
+        epoch = db.bump_token_epoch(user_id)
+        response.update(issue_tokens(user_id, {'username': user['username'],
+                                               'epoch': epoch}))
+        token_cache.revoke(user_id)
+        leaderboard.rename(user_id, user['username'])
 
     # Return response
-    return jsonify({'success': 'user updated'}), 201
+    return jsonify(response), 201
 
 
 @profile_bp.route('/update_password', methods=['PUT'])
@@ -228,10 +299,15 @@ def delete_post():
     if not post_id:
         return jsonify({'error': 'Missing post_id'}), 400
 
-    if not db.find_post({'_id': ObjectId(post_id), 'user_id': user_id}):
+    post = db.find_post({'_id': ObjectId(post_id), 'user_id': user_id})
+    if not post:
         return jsonify({'error': 'You have no post with this post_id'}), 400
 
     if db.delete_post(post_id, user_id) is True:
+        timeline.remove_posts(post_id)
+        activity.remove_entry(user_id, post['datePosted'])
+        if post['is_public']:
+            feed_cache.bump()
         return jsonify({'success': 'deleted post'}), 200
     else:
         return jsonify({'error': 'something went wrong'}), 500
@@ -247,8 +323,13 @@ def delete_user():
 
     # Get the user_id
     user_id = get_jwt_identity()
+    username = current_username()
 
-    if db.delete_user(user_id) is True:
+    # Hide the account at once, and delete its data in the background
+    if db.mark_user_deleted(user_id) is True:
+        revoke_tokens(user_id)
+        leaderboard.remove_user(user_id)
+        jobs.enqueue('delete_user', user_id=user_id, username=username)
         return jsonify({'success': 'account deleted'}), 200
     else:
         return jsonify({'error': 'something went wrong'}), 500
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Streamed responses for large lists, one JSON document per line
+"""
+from flask import Response, current_app, request, stream_with_context
+from typing import Any, Callable, Dict, Iterable, Optional
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def wants_stream() -> bool:
+    """Tell if the client asked for a streamed NDJSON response, with
+    `?stream=1` or an `Accept: application/x-ndjson` header
+    """
+    if request.args.get('stream') == '1':
+        return True
+
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]
+    )
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_response(
+        docs: Iterable[Dict[str, Any]],
+        serialize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+) -> Response:
+    """Stream documents as they come, each serialized on its own line
+    """
+    if serialize is not None:
+        docs = map(serialize, docs)
+
+    def generate():
+        for doc in docs:
+            yield current_app.json.dumps(doc) + '\n'
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        mimetype=NDJSON_MIMETYPE
+    )
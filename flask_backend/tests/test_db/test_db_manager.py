@@ -3,11 +3,13 @@
 Module unittest for the db_manager.
 """
 import unittest
+import types
 from unittest.mock import patch
 import mongomock
 from db import db
 from bson import ObjectId
-from datetime import datetime
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from datetime import datetime, timedelta
 
 
 class TestDBStorage(unittest.TestCase):
@@ -64,6 +66,28 @@ class TestDBStorage(unittest.TestCase):
         self.assertEqual(inserted_doc['email'], 'mohamed@example.com')
         self.assertEqual(inserted_doc['longest_streak'], 2)
 
+    def test_authenticate(self):
+        """ Test fetching a user by its credentials """
+        user_document = {
+            'username': 'Mohamed',
+            'email': 'mohamed@example.com',
+            'password': 'password123',
+            'longest_streak': 0
+        }
+        inserted_id = self.db.insert_user(user_document)
+
+        timings = {}
+        user = self.db.authenticate('mohamed@example.com', 'password123',
+                                    timings)
+        self.assertEqual(user, {'_id': str(inserted_id),
+                                'username': 'Mohamed'})
+        self.assertEqual(set(timings), {'db', 'hash'})
+
+        self.assertIsNone(self.db.authenticate('mohamed@example.com',
+                                               'wrongpassword'))
+        self.assertIsNone(self.db.authenticate('nobody@example.com',
+                                               'password123'))
+
     def test_update_user_password(self):
         """ Test updating user's password. """
         user_document = {
@@ -251,6 +275,279 @@ class TestDBStorage(unittest.TestCase):
         self.assertEqual(posts[0]['user_id'], str(inserted_user_id))
         self.assertEqual(posts[1]['user_id'], str(inserted_user_id))
 
+    def test_find_feed_posts(self):
+        """ Test getting public posts from the most to the less recent """
+        now = datetime.utcnow().replace(microsecond=0)
+        for i in range(5):
+            self.db.insert_post({
+                'user_id': ObjectId(),
+                'title': f'Post {i}',
+                'content': 'Post content',
+                'is_public': i != 2,
+                'datePosted': now + timedelta(hours=i)
+            })
+
+        feed = self.db.find_feed_posts()
+        self.assertEqual(
+            [p['title'] for p in feed],
+            ['Post 4', 'Post 3', 'Post 1', 'Post 0']
+        )
+
+        page = self.db.find_feed_posts(limit=2, skip=1)
+        self.assertEqual([p['title'] for p in page], ['Post 3', 'Post 1'])
+
+        after = (feed[1]['datePosted'], ObjectId(feed[1]['_id']))
+        page = self.db.find_feed_posts(limit=2, after=after)
+        self.assertEqual([p['title'] for p in page], ['Post 1', 'Post 0'])
+
+    def test_iter_posts_and_users(self):
+        """ Test iterating lazily over posts and users """
+        user_id = str(self.db.insert_user({
+            'username': 'Mohamed',
+            'email': 'mohamed@example.com',
+            'password': 'password123',
+            'longest_streak': 0
+        }))
+        now = datetime.utcnow().replace(microsecond=0)
+        for i in range(5):
+            self.db.insert_post({
+                'user_id': user_id,
+                'title': f'Post {i}',
+                'content': 'Post content',
+                'is_public': True,
+                'datePosted': now + timedelta(hours=i)
+            })
+
+        posts = self.db.iter_user_posts(user_id, batch_size=2)
+        self.assertIsInstance(posts, types.GeneratorType)
+        self.assertEqual([p['title'] for p in posts],
+                         ['Post 4', 'Post 3', 'Post 2', 'Post 1', 'Post 0'])
+
+        posts = list(self.db.iter_feed_posts(projection={'title': 1},
+                                             limit=2))
+        self.assertEqual(posts, [
+            {'_id': posts[0]['_id'], 'title': 'Post 4'},
+            {'_id': posts[1]['_id'], 'title': 'Post 3'}
+        ])
+
+        self.assertEqual(len(list(self.db.iter_all_posts(batch_size=1))), 5)
+
+        users = list(self.db.iter_all_users(projection={'email': 0}))
+        self.assertEqual(len(users), 1)
+        self.assertNotIn('password', users[0])
+        self.assertNotIn('email', users[0])
+        self.assertEqual(users[0]['username'], 'Mohamed')
+
+        # Posts of the same date are resumed by their _id
+        same_date = [str(self.db.insert_post({
+            'user_id': user_id,
+            'title': f'Same date {i}',
+            'content': 'Post content',
+            'is_public': False,
+            'datePosted': now
+        })) for i in range(3)]
+        posts = list(self.db.iter_user_posts(
+            user_id, after=(now, ObjectId(same_date[2]))
+        ))
+        self.assertEqual([p['title'] for p in posts],
+                         ['Same date 1', 'Same date 0', 'Post 0'])
+
+    def test_rebuild_streaks(self):
+        """ Test recomputing streaks from the dates of posts """
+        user_id = str(self.db.insert_user({
+            'username': 'Mohamed',
+            'email': 'mohamed@example.com',
+            'password': 'password123',
+            'longest_streak': 0
+        }))
+        now = datetime.utcnow()
+        hours = [
+            # A 3 days streak, with two posts on its second day
+            -200, -178, -175, -154,
+            # A gap of more than 28 hours, then a 2 days streak
+            -22, -1
+        ]
+        for h in hours:
+            self.db.insert_post({
+                'user_id': user_id,
+                'title': 'Post',
+                'content': 'Post content',
+                'is_public': False,
+                'datePosted': now + timedelta(hours=h)
+            })
+
+        self.assertEqual(self.db.rebuild_streaks(28 * 3600, 20 * 3600), 1)
+
+        streak = self.db.find_streak(user_id)
+        self.assertEqual(streak['current'], 2)
+        self.assertEqual(streak['longest'], 3)
+        user = self.db.find_user({'_id': ObjectId(user_id)})
+        self.assertEqual(user['longest_streak'], 3)
+
+    def test_rebuild_streaks_keeps_recorded_entries(self):
+        """ Test rebuilding streaks keeps entries recorded meanwhile, and
+        forgets users without posts
+        """
+        user_id = str(ObjectId())
+        now = datetime.utcnow()
+        self.db.insert_post({
+            'user_id': user_id,
+            'title': 'Post',
+            'content': 'Post content',
+            'is_public': False,
+            'datePosted': now - timedelta(hours=1)
+        })
+        # Recorded while the posts were being read
+        self.db.record_streak_entry(user_id, 5, now + timedelta(minutes=1))
+        self.db.record_streak_entry(str(ObjectId()), 4,
+                                    now - timedelta(days=9))
+
+        self.assertEqual(self.db.rebuild_streaks(28 * 3600, 20 * 3600), 1)
+
+        streak = self.db.find_streak(user_id)
+        self.assertEqual(streak['current'], 5)
+        self.assertEqual(streak['longest'], 5)
+
+    def test_like_and_unlike_post(self):
+        """ Test liking and unliking a post """
+        user_id = str(ObjectId())
+        post_id = str(self.db.insert_post({
+            'user_id': ObjectId(),
+            'title': 'Post title',
+            'content': 'Post content',
+            'is_public': True,
+            'number_of_likes': 0
+        }))
+
+        self.assertEqual(self.db.like_post(user_id, post_id), 0)
+        self.assertEqual(self.db.like_post(user_id, post_id), -2)
+        self.assertEqual(self.db.like_post(user_id, str(ObjectId())), -1)
+
+        post = self.db.find_post({'_id': ObjectId(post_id)})
+        self.assertEqual(post['number_of_likes'], 1)
+        self.assertEqual(self.db.liked_post_ids(user_id, [post_id]),
+                         {post_id})
+
+        self.assertEqual(self.db.unlike_post(user_id, post_id), 0)
+        self.assertEqual(self.db.unlike_post(user_id, post_id), -2)
+        self.assertEqual(self.db.unlike_post(user_id, str(ObjectId())), -1)
+
+        post = self.db.find_post({'_id': ObjectId(post_id)})
+        self.assertEqual(post['number_of_likes'], 0)
+        self.assertEqual(self.db.liked_post_ids(user_id, [post_id]), set())
+
+    def test_migrate_likes(self):
+        """ Test moving the likes arrays into the likes collection """
+        user_id = self.db.insert_user({
+            'username': 'Mohamed',
+            'email': 'mohamed@example.com',
+            'password': 'password123',
+            'longest_streak': 0
+        })
+        post_id = self.db.insert_post({
+            'user_id': ObjectId(),
+            'title': 'Post title',
+            'content': 'Post content',
+            'is_public': True,
+            'likes': ['Mohamed', 'Deleted user'],
+            'number_of_likes': 2
+        })
+
+        self.assertEqual(self.db.migrate_likes(), 1)
+        self.assertEqual(self.db.migrate_likes(), 0)
+
+        post = self.db.find_post({'_id': post_id})
+        self.assertNotIn('likes', post)
+        self.assertEqual(post['number_of_likes'], 1)
+        self.assertEqual(
+            self.db.liked_post_ids(str(user_id), [str(post_id)]),
+            {str(post_id)}
+        )
+
+    def test_ensure_indexes(self):
+        """ Test that the declared indexes exist and are applied once """
+        created = self.db.ensure_indexes()
+        self.assertEqual(created, {
+            'users': [], 'posts': [], 'comments': [], 'likes': []
+        })
+
+        # mongomock has no $indexStats, answer like a server without it
+        with patch.object(mongomock.collection.Collection, 'aggregate',
+                          side_effect=OperationFailure('$indexStats')):
+            report = self.db.index_report()
+        for collection in ('users', 'posts', 'comments', 'likes'):
+            self.assertEqual(report[collection]['missing'], [])
+
+    def test_audit_queries(self):
+        """ Test that only maintenance queries scan whole collections """
+        report = self.db.audit_queries()
+        self.assertTrue(report)
+
+        for query in report:
+            self.assertNotIn('SORT', query['problems'], query)
+            if query['problems']:
+                self.assertTrue(query['expected'], query)
+
+    def test_retired_index_is_dropped(self):
+        """ Test that ensure_indexes drops the indexes no longer declared """
+        comments = self.db._db['comments']
+        comments.create_index([('post_id', 1), ('date_posted', 1)],
+                              name='post_id_date_posted')
+
+        self.db.ensure_indexes()
+        self.assertNotIn('post_id_date_posted', comments.index_information())
+
+    def test_unique_index_blocked_by_duplicates(self):
+        """ Test that ensure_indexes raises when a unique index can't be
+        built
+        """
+        users = self.db._db['users']
+        users.drop_index('email')
+        users.insert_many([
+            {'username': 'Mohamed', 'email': 'mohamed@example.com'},
+            {'username': 'Mohamed2', 'email': 'mohamed@example.com'},
+        ])
+
+        with self.assertRaises(OperationFailure):
+            self.db.ensure_indexes()
+
+    def test_unique_email_and_username(self):
+        """ Test that two users can't share an email or a username """
+        self.db.insert_user({
+            'username': 'Mohamed',
+            'email': 'mohamed@example.com',
+            'password': 'password123',
+            'longest_streak': 0
+        })
+
+        with self.assertRaises(DuplicateKeyError):
+            self.db.insert_user({
+                'username': 'Mohamed2',
+                'email': 'mohamed@example.com',
+                'password': 'password123',
+                'longest_streak': 0
+            })
+
+        document = {
+            'username': 'Mohamed',
+            'email': 'mohamed2@example.com',
+            'password': 'password123',
+            'longest_streak': 0
+        }
+        with self.assertRaises(DuplicateKeyError) as cm:
+            self.db.insert_user(document)
+
+        self.assertEqual(
+            self.db.duplicate_user_field(cm.exception, document),
+            'username'
+        )
+
+        # The key the server reports is trusted
+        err = DuplicateKeyError('E11000 duplicate key error', 11000,
+                                {'keyPattern': {'email': 1}})
+        self.assertEqual(self.db.duplicate_user_field(err, document),
+                         'email')
+
 
 class TestComment(unittest.TestCase):
     """ Tests for the comment document """
@@ -450,6 +747,54 @@ class TestComment(unittest.TestCase):
 
         self.assertEqual(len(comments), 2)
 
+    def test_comments_preview(self):
+        """ Test that posts only embed their latest comments """
+        comment_ids = [
+            self.db.insert_comment({
+                'user_id': self.inserted_user_id,
+                'username': self.user_document['username'],
+                'body': f'Comment {i}',
+                'post_id': self.inserted_post_id
+            }, self.inserted_post_id)
+            for i in range(5)
+        ]
+
+        post = self.db.find_post({'_id': self.inserted_post_id})
+        self.assertEqual(post['number_of_comments'], 5)
+        self.assertEqual([c['_id'] for c in post['comments']],
+                         [str(i) for i in comment_ids[-3:]])
+
+        # Deleting a previewed comment brings back an older one
+        self.db.delete_comment(str(comment_ids[4]),
+                               self.user_document['username'],
+                               self.inserted_post_id)
+
+        post = self.db.find_post({'_id': self.inserted_post_id})
+        self.assertEqual(post['number_of_comments'], 4)
+        self.assertEqual([c['_id'] for c in post['comments']],
+                         [str(i) for i in comment_ids[1:4]])
+
+    def test_get_post_comments_pages(self):
+        """ Test paginating the comments of a post """
+        comment_ids = [
+            self.db.insert_comment({
+                'user_id': self.inserted_user_id,
+                'username': self.user_document['username'],
+                'body': f'Comment {i}',
+                'post_id': self.inserted_post_id
+            }, self.inserted_post_id)
+            for i in range(5)
+        ]
+
+        page = self.db.get_post_comments(self.inserted_post_id, limit=2)
+        self.assertEqual([c['_id'] for c in page],
+                         [str(i) for i in comment_ids[:2]])
+
+        page = self.db.get_post_comments(self.inserted_post_id,
+                                         after=page[-1]['_id'], limit=2)
+        self.assertEqual([c['_id'] for c in page],
+                         [str(i) for i in comment_ids[2:4]])
+
     def test_delete_comments_post(self):
         """ Test for removing all comments associated with a post
         when the post is deleted"""
@@ -458,7 +803,103 @@ class TestComment(unittest.TestCase):
     def test_delete_comments_user(self):
         """ Test for removing all comments associated with a post
         when the user is deleted"""
-        pass
+        user_id = str(self.inserted_second_user_id)
+        own_post_id = self.db.insert_post({
+            'user_id': user_id,
+            'title': 'Own post',
+            'content': 'Own post content',
+            'comments': [],
+            'number_of_comments': 0
+        })
+        comment_id = self.db.insert_comment({
+            'user_id': self.inserted_second_user_id,
+            'username': self.second_user_document['username'],
+            'body': 'First comment',
+            'post_id': self.inserted_post_id
+        }, self.inserted_post_id)
+        self.db.like_post(user_id, str(self.inserted_post_id))
+        like_id = self.db._db['likes'].find_one(
+            {'user_id': self.inserted_second_user_id}
+        )['_id']
+        self.db.mark_user_deleted(user_id)
+
+        # A deleted user can't log in
+        self.assertIsNone(self.db.authenticate(
+            self.second_user_document['email'], 'password123'
+        ))
+
+        purged = list(self.db.purge_user(user_id, batch_size=1))
+        self.assertEqual(purged, [
+            ('posts', [str(own_post_id)]),
+            ('comments', [str(comment_id)]),
+            ('comments_previews', [str(self.inserted_post_id)]),
+            ('likes', [str(like_id)]),
+            ('users', [user_id])
+        ])
+
+        # The user's data are gone, and uncounted from the other post
+        self.assertIsNone(self.db.find_post({'_id': own_post_id}))
+        self.assertIsNone(self.db.find_comment(
+            comment_id, self.second_user_document['username']
+        ))
+        self.assertIsNone(self.db.find_user(
+            {'_id': self.inserted_second_user_id}
+        ))
+
+        post = self.db.find_post({'_id': self.inserted_post_id})
+        self.assertEqual(post['number_of_comments'], 0)
+        self.assertEqual(post['number_of_likes'], 0)
+        self.assertEqual(post['comments'], [])
+
+        # Purging again finds nothing left
+        self.assertEqual(list(self.db.purge_user(user_id)), [])
+
+    def test_propagate_username_to_previews(self):
+        """ Test that a new username reaches the user's comments embedded
+        in posts, whether their user_id is a string or an ObjectId """
+        user_id = self.inserted_second_user_id
+        old_username = self.second_user_document['username']
+        self.db._db['posts'].update_one(
+            {'_id': self.inserted_post_id},
+            {'$set': {'comments': [
+                {'_id': str(ObjectId()), 'user_id': user_id,
+                 'username': old_username, 'body': 'Legacy comment'},
+                {'_id': str(ObjectId()), 'user_id': str(user_id),
+                 'username': old_username, 'body': 'New comment'},
+                {'_id': str(ObjectId()), 'user_id': str(ObjectId()),
+                 'username': 'someone', 'body': 'Other comment'},
+            ]}}
+        )
+
+        list(self.db.propagate_username(str(user_id), old_username,
+                                        'renamed'))
+
+        post = self.db.find_post({'_id': self.inserted_post_id})
+        self.assertEqual([c['username'] for c in post['comments']],
+                         ['renamed', 'renamed', 'someone'])
+
+    def test_delete_legacy_comments_preview(self):
+        """ Test that purging a user removes their comments from previews
+        written before their user_id was serialized """
+        user_id = str(self.inserted_second_user_id)
+        comment = {
+            'user_id': self.inserted_second_user_id,
+            'username': self.second_user_document['username'],
+            'body': 'Legacy comment',
+            'post_id': self.inserted_post_id
+        }
+        comment_id = self.db._db['comments'].insert_one(comment).inserted_id
+        self.db._db['posts'].update_one(
+            {'_id': self.inserted_post_id},
+            {'$set': {'comments': [{**comment, '_id': str(comment_id)}],
+                      'number_of_comments': 1}}
+        )
+
+        list(self.db.purge_user(user_id))
+
+        post = self.db.find_post({'_id': self.inserted_post_id})
+        self.assertEqual(post['comments'], [])
+        self.assertEqual(post['number_of_comments'], 0)
 
 
 if __name__ == '__main__':
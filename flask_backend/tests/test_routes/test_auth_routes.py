@@ -3,9 +3,14 @@
 """
 from config import TestConfig
 from datetime import datetime
-from db import db, redis_client as rc
+from db import db, redis_client as rc, token_cache
+from db import password_service
 from db.db_manager import check_hash_password
+from flask_jwt_extended import decode_token
 from main import create_app
+from threading import Semaphore
+from time import sleep
+from unittest.mock import patch
 import unittest
 
 
@@ -172,6 +177,38 @@ class LoginTests(unittest.TestCase):
         self.assertIn('access_token', data)
         self.assertIn('refresh_token', data)
 
+        # Verify the time spent on each stage is reported
+        timing = res.headers['Server-Timing']
+        self.assertEqual([m.split(';')[0] for m in timing.split(', ')],
+                         ['db', 'hash', 'token'])
+
+        # Verify the tokens carry the username and token epoch
+        with self.app.app_context():
+            for token in (data['access_token'], data['refresh_token']):
+                claims = decode_token(token)
+                self.assertEqual(claims['username'], 'mohamed')
+                self.assertEqual(claims['epoch'], 0)
+
+    def test_login_when_password_service_busy(self):
+        """ Test logging in while too many passwords wait to be hashed """
+        with patch.object(password_service, '_slots', Semaphore(0)):
+            res = self.client.post('/api/login', json=self.login_detail)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(data, {'error': 'Too many requests, retry later'})
+
+    def test_login_after_password_worker_died(self):
+        """ Test logging in still works once a hashing worker was killed """
+        password_service.hash_password('warm up')
+        for process in list(password_service._pool._processes.values()):
+            process.kill()
+            process.join()
+
+        res = self.client.post('/api/login', json=self.login_detail)
+        self.assertEqual(res.status_code, 200)
+
     def test_login_with_bad_email(self):
         """ Test logging a user with incorrect email  """
         login_detail = {
@@ -409,3 +446,85 @@ class LoggedInTests(unittest.TestCase):
 
         self.assertEqual(res.status_code, 401)
         self.assertEqual(data, {'error': 'Token has been revoked'})
+
+
+class CachedTokenConfig(TestConfig):
+    """Testing configuration with the JWT cache enabled
+    """
+    TOKEN_CACHE_TTL = 60
+
+
+class TestTokenCache(unittest.TestCase):
+    """ Tests for the in-process cache of validated JWTs """
+
+    def setUp(self):
+        """Log a user in with the JWT cache enabled
+        """
+        self.app = create_app(CachedTokenConfig)
+        self.client = self.app.test_client()
+
+        info = {
+            'email': 'mohamed@example.com',
+            'username': 'mohamed',
+            'password': 'pass123',
+            'longest_streak': 0
+        }
+        self.user_id = str(db.insert_user(info))
+
+        res = self.client.post('/api/login', json={
+            'email': 'mohamed@example.com',
+            'password': 'pass123'
+        })
+        self.headers = {
+            'Authorization': f"Bearer {res.get_json()['access_token']}"
+        }
+
+    def tearDown(self):
+        """Clear database
+        """
+        db.clear_db()
+        rc.flushall()
+
+    def test_cached_token(self):
+        """ Test a validated token is trusted without asking Redis """
+        before = token_cache.stats()
+
+        self.assertEqual(self.client.get('/api/',
+                                         headers=self.headers).status_code,
+                         200)
+
+        # Deleting the token behind the cache's back goes unnoticed
+        rc.delete(self.user_id)
+        self.assertEqual(self.client.get('/api/',
+                                         headers=self.headers).status_code,
+                         200)
+
+        after = token_cache.stats()
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+    def test_logout_revokes_cached_token(self):
+        """ Test logging out drops the cached token """
+        self.client.get('/api/', headers=self.headers)
+
+        res = self.client.post('/api/logout', headers=self.headers)
+        self.assertEqual(res.status_code, 204)
+
+        res = self.client.get('/api/', headers=self.headers)
+        self.assertEqual(res.status_code, 401)
+
+    def test_revocation_from_another_process(self):
+        """ Test a revocation published elsewhere drops the cached token """
+        self.client.get('/api/', headers=self.headers)
+
+        # Another process logs the user out, once this one listens
+        rc.delete(self.user_id, self.user_id + '_refresh')
+
+        for _ in range(30):
+            rc.publish(token_cache.CHANNEL, self.user_id)
+            res = self.client.get('/api/', headers=self.headers)
+            if res.status_code == 401:
+                break
+            sleep(0.1)
+
+        self.assertEqual(res.status_code, 401)
@@ -3,7 +3,7 @@
 """
 from config import TestConfig
 from datetime import datetime, timedelta
-from db import db, redis_client as rc
+from db import db, redis_client as rc, timeline
 from flask_jwt_extended import create_access_token
 from routes.auth import store_token
 from main import create_app
@@ -90,6 +90,8 @@ class TestGetFeedPosts(unittest.TestCase):
             if i % 2 == 0:
                 p = post.copy()
                 p['_id'] = str(p['_id'])
+                del p['likes']
+                p['liked_by_me'] = False
                 cls.public_posts.append(p)
 
         # Sort posts from the most to the less recent
@@ -246,6 +248,337 @@ class TestGetFeedPosts(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(data, {'error': 'page argument must be an integer'})
 
+    def test_get_feed_with_cursors(self):
+        """Test walking through the feed with the next page cursors
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=headers)
+        received = response.get_json()
+        cursor = response.headers.get('X-Next-Cursor')
+
+        while cursor:
+            response = self.client.get(
+                f'/api/feed/get_posts?after={cursor}', headers=headers
+            )
+            self.assertEqual(response.status_code, 200)
+            received.extend(response.get_json())
+            cursor = response.headers.get('X-Next-Cursor')
+
+        # Verify that every public post was received once, in order
+        self.assertEqual(received, self.public_posts)
+
+    def test_get_feed_streamed(self):
+        """Test streaming feed's posts as NDJSON
+        """
+        response = self.client.get('/api/feed/get_posts?stream=1', headers={
+            'Authorization': 'Bearer ' + self.access_token
+        })
+
+        # Verify response
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         self.public_posts)
+
+    def test_get_feed_invalid_cursor(self):
+        """Test getting feed's with a forged cursor
+        """
+        response = self.client.get('/api/feed/get_posts?after=forged',
+                                   headers={
+                                       'Authorization': 'Bearer ' +
+                                       self.access_token
+                                   })
+        data = response.get_json()
+
+        # Verify response
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data, {'error': 'invalid after cursor'})
+
+
+class TestTimelineFeed(unittest.TestCase):
+    """ Tests for 'GET /feed/get_posts' served by the Redis timeline """
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once before all tests
+        """
+
+        # Create app
+        cls.app = create_app(TestConfig)
+
+        # Create client
+        cls.client = cls.app.test_client()
+
+        # Create dummy user
+        infos = {
+            'username': 'albushog99',
+            'email': 'lumos@poud.mgc',
+            'password': 'gumbledore',
+            'longest_streak': 0
+        }
+        cls.user_id = str(db.insert_user(infos))
+
+        # Create JWT Access Token
+        with cls.app.app_context():
+            cls.access_token = create_access_token(
+                identity=cls.user_id
+            )
+
+        # Store JWT Access Token
+        store_token(
+            cls.user_id,
+            cls.access_token,
+            cls.app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+        )
+
+        # Create dummy posts, half of them public
+        cls.public_posts = []
+
+        for i in range(1, 51):
+            post = {
+                'user_id': cls.user_id,
+                'username': 'albushog99',
+                'title': f'Title {i}',
+                'content': f'This is post {i}',
+                'is_public': i % 2 == 0,
+                'likes': [],
+                'number_of_likes': 0,
+                'comments': [],
+                'number_of_comments': 0,
+                'datePosted': datetime.utcnow() - timedelta(hours=i)
+            }
+            db.insert_post(post)
+
+            if post['is_public']:
+                p = post.copy()
+                p['_id'] = str(p['_id'])
+                del p['likes']
+                p['liked_by_me'] = False
+                p['datePosted'] = p['datePosted'].strftime(
+                    '%Y/%m/%d %H:%M:%S'
+                )
+                cls.public_posts.append(p)
+
+        # Build the timeline
+        timeline.rebuild(db.iter_public_post_dates())
+
+    @classmethod
+    def tearDownClass(cls):
+        """Clear Mongo and Redis databases
+        """
+        db.clear_db()
+        rc.flushdb()
+
+    def test_timeline_is_built(self):
+        """Test that the timeline holds every public post
+        """
+        self.assertEqual(rc.zcard(timeline.TIMELINE_KEY), 25)
+        self.assertEqual(timeline.page(0, 1), [self.public_posts[0]['_id']])
+
+    def test_writes_during_rebuild(self):
+        """Test that posts added or removed while the timeline is rebuilt
+        are not lost or brought back
+        """
+        removed_id = self.public_posts[0]['_id']
+        added_id = str(ObjectId())
+
+        def public_posts():
+            for i, post in enumerate(db.iter_public_post_dates()):
+                if i == 1:
+                    timeline.remove_posts(removed_id)
+                    timeline.add_post(added_id, datetime.utcnow())
+                yield post
+
+        timeline.rebuild(public_posts(), batch_size=10)
+
+        ids = [i.decode('utf-8')
+               for i in rc.zrange(timeline.TIMELINE_KEY, 0, -1)]
+        self.assertNotIn(removed_id, ids)
+        self.assertIn(added_id, ids)
+        self.assertEqual(len(ids), 25)
+
+        # Writes no longer go to a rebuild once it is swapped in
+        self.assertFalse(rc.exists(timeline.REBUILD_KEY,
+                                   timeline.REBUILDING_KEY,
+                                   timeline.REMOVED_KEY))
+
+        timeline.rebuild(db.iter_public_post_dates())
+
+    def test_get_feed_pages(self):
+        """Test getting the feed's pages from the timeline
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=headers)
+        self.assertEqual(response.get_json(), self.public_posts[:20])
+
+        response = self.client.get('/api/feed/get_posts?page=2',
+                                   headers=headers)
+        self.assertEqual(response.get_json(), self.public_posts[20:])
+
+        cursor = response.headers.get('X-Next-Cursor')
+        self.assertIsNone(cursor)
+
+    def test_get_feed_with_cursor(self):
+        """Test getting the page following a cursor from the timeline
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=headers)
+        cursor = response.headers.get('X-Next-Cursor')
+
+        response = self.client.get(f'/api/feed/get_posts?after={cursor}',
+                                   headers=headers)
+        self.assertEqual(response.get_json(), self.public_posts[20:])
+
+    def test_timeline_follows_writes(self):
+        """Test that logging and deleting a public post update the timeline
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+
+        response = self.client.post('/api/log', headers=headers, json={
+            'title': 'Fresh post',
+            'content': 'Here is my post',
+            'is_public': True
+        })
+        post_id = response.get_json()['_id']
+
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=headers)
+        self.assertEqual(response.get_json()[0]['_id'], post_id)
+
+        self.client.delete('/api/me/delete_post', headers=headers,
+                           json={'post_id': post_id})
+
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=headers)
+        self.assertEqual(response.get_json(), self.public_posts[:20])
+
+
+class CachedFeedConfig(TestConfig):
+    """Testing configuration with the feed cache enabled
+    """
+    FEED_CACHE_TTL = 60
+
+
+class TestFeedCache(unittest.TestCase):
+    """ Tests for the cache of 'GET /feed/get_posts' pages """
+
+    def setUp(self):
+        """ Runs once before every test """
+        self.app = create_app(CachedFeedConfig)
+        self.client = self.app.test_client()
+
+        info = {
+            'email': 'mohamed@example.com',
+            'username': 'mohamed',
+            'password': 'pass123',
+            'longest_streak': 0
+        }
+        db.insert_user(info)
+
+        self.post_id = db.insert_post({
+            'user_id': str(ObjectId()),
+            'username': 'youssef',
+            'title': 'Post title',
+            'content': 'Post content',
+            'is_public': True,
+            'likes': [],
+            'number_of_likes': 0,
+            'comments': [],
+            'number_of_comments': 0,
+            'datePosted': datetime.utcnow()
+        })
+
+        res = self.client.post('/api/login', json={
+            'email': 'mohamed@example.com',
+            'password': 'pass123'
+        })
+        self.headers = {
+            'Authorization': f"Bearer {res.get_json()['access_token']}"
+        }
+
+    def tearDown(self):
+        """ Runs once after every test """
+        db.clear_db()
+        rc.flushall()
+
+    def test_cached_page(self):
+        """ Test that an unchanged page is served from the cache """
+        first = self.client.get('/api/feed/get_posts?page=1',
+                                headers=self.headers)
+        second = self.client.get('/api/feed/get_posts?page=1',
+                                 headers=self.headers)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.get_data(), second.get_data())
+
+        response = self.client.get('/api/stats', headers=self.headers)
+        stats = response.get_json()['feed_cache']
+
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_cached_page_flags_likes(self):
+        """ Test that a cached page flags the posts liked by the user """
+        self.client.post('/api/feed/like', headers=self.headers,
+                         json={'post_id': str(self.post_id)})
+
+        first = self.client.get('/api/feed/get_posts?page=1',
+                                headers=self.headers)
+        second = self.client.get('/api/feed/get_posts?page=1',
+                                 headers=self.headers)
+
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(second.get_json()[0]['_id'], str(self.post_id))
+        self.assertTrue(second.get_json()[0]['liked_by_me'])
+
+    def test_page_after_last_full_page(self):
+        """ Test that the page after the last full one is empty, and the
+        next one out of range """
+        for i in range(19):
+            db.insert_post({
+                'user_id': str(ObjectId()),
+                'username': 'youssef',
+                'title': f'Post {i}',
+                'content': 'Post content',
+                'is_public': True,
+                'number_of_likes': 0,
+                'comments': [],
+                'number_of_comments': 0,
+                'datePosted': datetime.utcnow()
+            })
+
+        response = self.client.get('/api/feed/get_posts?page=2',
+                                   headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), [])
+
+        response = self.client.get('/api/feed/get_posts?page=3',
+                                   headers=self.headers)
+        self.assertEqual(response.get_json(), {'info': 'page out of range'})
+
+    def test_write_invalidates_cache(self):
+        """ Test that liking a post invalidates the cached pages """
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=self.headers)
+        self.assertEqual(response.get_json()[0]['number_of_likes'], 0)
+
+        self.client.post('/api/feed/like', headers=self.headers,
+                         json={'post_id': str(self.post_id)})
+
+        response = self.client.get('/api/feed/get_posts?page=1',
+                                   headers=self.headers)
+        self.assertEqual(response.get_json()[0]['number_of_likes'], 1)
+
 
 class TestLikeUnlike(unittest.TestCase):
     """ Tests for liking and unliking routes """
@@ -313,7 +646,10 @@ class TestLikeUnlike(unittest.TestCase):
         post = db.find_post({'_id': self.post_id, 'user_id': self.dummy_user})
 
         self.assertEqual(post['number_of_likes'], 1)
-        self.assertIn(self.username, post['likes'])
+        self.assertEqual(
+            db.liked_post_ids(self.user_id, [str(self.post_id)]),
+            {str(self.post_id)}
+        )
 
     def test_like_post_twice(self):
         """ Test for liking posts that's already liked by the current user """
@@ -336,7 +672,10 @@ class TestLikeUnlike(unittest.TestCase):
         post = db.find_post({'_id': self.post_id, 'user_id': self.dummy_user})
 
         self.assertEqual(post['number_of_likes'], 1)
-        self.assertIn(self.username, post['likes'])
+        self.assertEqual(
+            db.liked_post_ids(self.user_id, [str(self.post_id)]),
+            {str(self.post_id)}
+        )
 
         res = self.client.post(
             '/api/feed/like', headers=headers, data=json.dumps(dump)
@@ -424,7 +763,9 @@ class TestLikeUnlike(unittest.TestCase):
         post = db.find_post({'_id': self.post_id, 'user_id': self.dummy_user})
 
         self.assertEqual(post['number_of_likes'], 0)
-        self.assertNotIn(self.username, post['likes'])
+        self.assertEqual(
+            db.liked_post_ids(self.user_id, [str(self.post_id)]), set()
+        )
 
     def test_unlike_post_twice(self):
         """ Test for unliking posts that's
@@ -450,7 +791,9 @@ class TestLikeUnlike(unittest.TestCase):
         post = db.find_post({'_id': self.post_id, 'user_id': self.dummy_user})
 
         self.assertEqual(post['number_of_likes'], 0)
-        self.assertNotIn(self.username, post['likes'])
+        self.assertEqual(
+            db.liked_post_ids(self.user_id, [str(self.post_id)]), set()
+        )
 
     def test_unlike_non_existing_post(self):
         """ Test unliking a post that's does not exist """
@@ -949,3 +1292,48 @@ class TestComments(unittest.TestCase):
         self.assertEqual(len(data['data']), 2)
         self.assertEqual(data['data'][0]['body'], 'Second Comment')
         self.assertEqual(data['data'][1]['body'], 'First Comment')
+
+    def test_get_post_comments_pages(self):
+        """ Test getting the comments of a post page by page """
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.access_token}',
+        }
+        for i in range(3):
+            self.client.post('/api/feed/comment', headers=headers,
+                             json={'post_id': str(self.post_id),
+                                   'body': f'Comment {i}'})
+
+        res = self.client.post('/api/feed/post_comments', headers=headers,
+                               json={'post_id': str(self.post_id),
+                                     'limit': 2})
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([c['body'] for c in data['data']],
+                         ['Comment 0', 'Comment 1'])
+        self.assertEqual(data['next'], data['data'][1]['_id'])
+
+        res = self.client.post('/api/feed/post_comments', headers=headers,
+                               json={'post_id': str(self.post_id),
+                                     'after': data['next'],
+                                     'limit': 2})
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([c['body'] for c in data['data']], ['Comment 2'])
+        self.assertIsNone(data['next'])
+
+    def test_get_post_comments_invalid_limit(self):
+        """ Test getting the comments of a post with a wrong page size """
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.access_token}',
+        }
+        res = self.client.post('/api/feed/post_comments', headers=headers,
+                               json={'post_id': str(self.post_id),
+                                     'limit': 0})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json(),
+                         {'error': 'limit must be between 1 and 50'})
@@ -8,7 +8,9 @@ from db import db, redis_client as rc
 from flask_jwt_extended import create_access_token
 from routes.auth import store_token
 from main import create_app
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
+from unittest.mock import patch
 import unittest
 
 
@@ -63,8 +65,9 @@ class TestCreateLog(unittest.TestCase):
         """Reset streaks after each test
         """
 
-        # Delete current streak key from Redis
+        # Delete current streak key from Redis, and streaks from MongoDB
         rc.delete(self.cs_key)
+        db.delete_streak(self.user_id)
 
         # Reset longest streak to 0
         db.update_user_info(self.user_id, {'longest_streak': 0})
@@ -106,7 +109,7 @@ class TestCreateLog(unittest.TestCase):
         self.assertEqual(post.get('content'), data['content'])
         self.assertEqual(post.get('is_public'), data['is_public'])
         self.assertEqual(post.get('number_of_likes'), 0)
-        self.assertEqual(post.get('likes'), [])
+        self.assertNotIn('likes', post)
         self.assertEqual(post.get('comments'), [])
         self.assertEqual(post.get('datePosted').strftime('%Y/%m/%d %H:%M:%S'),
                          data['datePosted'])
@@ -156,7 +159,7 @@ class TestCreateLog(unittest.TestCase):
         self.assertEqual(post.get('content'), data['content'])
         self.assertEqual(post.get('is_public'), data['is_public'])
         self.assertEqual(post.get('number_of_likes'), 0)
-        self.assertEqual(post.get('likes'), [])
+        self.assertNotIn('likes', post)
         self.assertEqual(post.get('comments'), [])
         self.assertEqual(post.get('datePosted').strftime('%Y/%m/%d %H:%M:%S'),
                          data['datePosted'])
@@ -168,6 +171,27 @@ class TestCreateLog(unittest.TestCase):
         user = db.find_user({'_id': ObjectId(self.user_id)})
         self.assertEqual(user['longest_streak'], 1)
 
+    def test_user_fetched_once(self):
+        """Test the user is read from MongoDB once per request
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+        payload = {
+            'title': 'My post',
+            'content': 'Here is my post'
+        }
+
+        with patch.object(db, 'find_user', wraps=db.find_user) as find_user:
+            response = self.client.post('/api/log', headers=headers,
+                                        json=payload)
+
+        # Verify response
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(find_user.call_count, 1)
+
+        # Verify longest streak
+        user = db.find_user({'_id': ObjectId(self.user_id)})
+        self.assertEqual(user['longest_streak'], 1)
+
     def test_with_no_auth(self):
         """Test with no authentication
         """
@@ -332,6 +356,58 @@ class TestCreateLog(unittest.TestCase):
         user = db.find_user({'_id': ObjectId(self.user_id)})
         self.assertEqual(user['longest_streak'], 1)
 
+    def test_concurrent_logs(self):
+        """Test only one of concurrent posts is accepted
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+
+        def post(i):
+            client = self.app.test_client()
+            return client.post('/api/log', headers=headers, json={
+                'title': f'My post {i}',
+                'content': f'Here is my post {i}'
+            }).status_code
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            statuses = sorted(executor.map(post, range(4)))
+
+        # Verify responses
+        self.assertEqual(statuses, [201, 400, 400, 400])
+
+        # Verify current streak
+        self.assertEqual(int(rc.get(self.cs_key).decode('utf-8')), 1)
+
+    def test_streak_survives_cache_loss(self):
+        """Test the current streak is restored from MongoDB
+        """
+        headers = {'Authorization': 'Bearer ' + self.access_token}
+        payload = {
+            'title': 'My post',
+            'content': 'Here is my post'
+        }
+
+        response = self.client.post('/api/log', headers=headers, json=payload)
+        self.assertEqual(response.status_code, 201)
+
+        # Lose the cache
+        rc.delete(self.cs_key)
+
+        # Still only one post per day
+        response = self.client.post('/api/log', headers=headers, json=payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'],
+                         'Only one post per day is allowed')
+
+        # Pass to the next day
+        rc.delete(self.cs_key)
+        sleep(2.1)
+
+        response = self.client.post('/api/log', headers=headers, json=payload)
+        self.assertEqual(response.status_code, 201)
+
+        # Verify current streak
+        self.assertEqual(int(rc.get(self.cs_key).decode('utf-8')), 2)
+
     def test_loosing_current_streak(self):
         """Test loosing current streak
         """
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Module to test the leaderboard routes
+"""
+from config import TestConfig
+from db import db, leaderboard, redis_client as rc
+from flask_jwt_extended import create_access_token
+from routes.auth import store_token
+from main import create_app
+from time import sleep
+import unittest
+
+
+class TestLeaderboard(unittest.TestCase):
+    """Tests for 'GET /leaderboard' route
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once before all tests
+        """
+
+        # Create app
+        cls.app = create_app(TestConfig)
+
+        # Create client
+        cls.client = cls.app.test_client()
+
+        # Create dummy users with their longest streaks
+        cls.user_ids = []
+        for i, streak in enumerate([3, 7, 0, 5]):
+            infos = {
+                'username': f'wizard{i}',
+                'email': f'wizard{i}@poud.mgc',
+                'password': 'gumbledore',
+                'longest_streak': streak
+            }
+            cls.user_ids.append(str(db.insert_user(infos)))
+
+        # Create and store JWT Access Token of the first user
+        with cls.app.app_context():
+            cls.access_token = create_access_token(
+                identity=cls.user_ids[0]
+            )
+
+        store_token(
+            cls.user_ids[0],
+            cls.access_token,
+            cls.app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+        )
+
+        cls.headers = {'Authorization': 'Bearer ' + cls.access_token}
+
+    @classmethod
+    def tearDownClass(cls):
+        """Clear Mongo and Redis databases
+        """
+        db.clear_db()
+        rc.flushdb()
+
+    def setUp(self):
+        """Rank the users' longest streaks
+        """
+        for key in (leaderboard.LONGEST_KEY, leaderboard.CURRENT_KEY,
+                    leaderboard.EXPIRY_KEY, leaderboard.USERNAMES_KEY):
+            rc.delete(key)
+
+        leaderboard.backfill(db.iter_all_users())
+
+    def test_longest_streaks(self):
+        """Test getting the top longest streaks and the user's rank
+        """
+        response = self.client.get('/api/leaderboard?limit=2',
+                                   headers=self.headers)
+        data = response.get_json()
+
+        # Verify response
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['board'], 'longest')
+        self.assertEqual(data['top'], [
+            {'rank': 1, 'user_id': self.user_ids[1],
+             'username': 'wizard1', 'streak': 7},
+            {'rank': 2, 'user_id': self.user_ids[3],
+             'username': 'wizard3', 'streak': 5}
+        ])
+        self.assertEqual(data['me'], {'rank': 3, 'streak': 3})
+
+    def test_log_updates_leaderboards(self):
+        """Test posting an entry ranks the user's streaks
+        """
+        response = self.client.post('/api/log', headers=self.headers, json={
+            'title': 'My post',
+            'content': 'Here is my post'
+        })
+        self.assertEqual(response.status_code, 201)
+
+        # The current streak is ranked
+        response = self.client.get('/api/leaderboard?board=current',
+                                   headers=self.headers)
+        data = response.get_json()
+
+        self.assertEqual(data['top'], [
+            {'rank': 1, 'user_id': self.user_ids[0],
+             'username': 'wizard0', 'streak': 1}
+        ])
+        self.assertEqual(data['me'], {'rank': 1, 'streak': 1})
+
+        # The longest streak is kept
+        response = self.client.get('/api/leaderboard', headers=self.headers)
+        self.assertEqual(response.get_json()['me'], {'rank': 3, 'streak': 3})
+
+        # The current streak leaves the board once it ends
+        sleep(4.1)
+        response = self.client.get('/api/leaderboard?board=current',
+                                   headers=self.headers)
+        data = response.get_json()
+
+        self.assertEqual(data['top'], [])
+        self.assertIsNone(data['me'])
+
+    def test_with_wrong_board(self):
+        """Test getting an unknown leaderboard
+        """
+        response = self.client.get('/api/leaderboard?board=shortest',
+                                   headers=self.headers)
+
+        # Verify response
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(),
+                         {'error': '`board` must be longest or current'})
+
+    def test_with_wrong_limit(self):
+        """Test getting too many users
+        """
+        response = self.client.get('/api/leaderboard?limit=1000',
+                                   headers=self.headers)
+
+        # Verify response
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(),
+                         {'error': '`limit` must be between 1 and 100'})
+
+    def test_with_no_auth(self):
+        """Test with no authentication
+        """
+        response = self.client.get('/api/leaderboard')
+
+        # Verify response
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json(),
+                         {'error': 'Missing Authorization Header'})
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Module to test the metrics route
+"""
+from config import TestConfig
+from db import db, redis_client as rc
+from flask_jwt_extended import create_access_token
+from routes.auth import store_token
+from main import create_app
+import metrics
+from prometheus_client import REGISTRY
+from types import SimpleNamespace
+import unittest
+
+
+class MetricsConfig(TestConfig):
+    """Testing configuration serving the metrics
+    """
+    SERVE_METRICS = True
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for 'GET /metrics' route
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once before all tests
+        """
+
+        # Create app
+        cls.app = create_app(MetricsConfig)
+
+        # Create client
+        cls.client = cls.app.test_client()
+
+        # Create dummy user
+        infos = {
+            'username': 'albushog99',
+            'email': 'lumos@poud.mgc',
+            'password': 'gumbledore',
+            'longest_streak': 0
+        }
+        cls.user_id = str(db.insert_user(infos))
+
+        # Create and store JWT Access Token
+        with cls.app.app_context():
+            cls.access_token = create_access_token(identity=cls.user_id)
+
+        store_token(
+            cls.user_id,
+            cls.access_token,
+            cls.app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        """Clear Mongo and Redis databases
+        """
+        db.clear_db()
+        rc.flushdb()
+
+    def test_request_is_recorded(self):
+        """Test a request's latency and calls show in the metrics
+        """
+        response = self.client.get('/api/me/get_infos', headers={
+            'Authorization': 'Bearer ' + self.access_token
+        })
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/metrics')
+        metrics = response.get_data(as_text=True)
+
+        # Verify response
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+
+        # The route's latency
+        self.assertIn('http_request_duration_seconds_count{'
+                      'endpoint="profile_bp.get_infos",method="GET",'
+                      'status="200"}', metrics)
+
+        # The Redis commands and DBStorage methods it called
+        self.assertIn('backend_calls_total{endpoint="profile_bp.get_infos",'
+                      'kind="dbstorage",name="find_user"}', metrics)
+        self.assertIn('backend_calls_total{endpoint="profile_bp.get_infos",'
+                      'kind="redis",name="PIPELINE"}', metrics)
+
+        # Their number per request
+        self.assertIn('request_backend_calls_count{'
+                      'endpoint="profile_bp.get_infos",kind="redis"}',
+                      metrics)
+
+    def test_streamed_response_is_recorded_once_sent(self):
+        """Test a streamed response's latency, size and calls are recorded
+        when it is closed, with the calls made while streaming
+        """
+        labels = {'method': 'GET', 'endpoint': 'profile_bp.get_posts',
+                  'status': '200'}
+
+        def sample(name, labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        latency = sample('http_request_duration_seconds_count', labels)
+        size = sample('http_response_size_bytes_sum', labels)
+        calls = sample('request_backend_calls_sum',
+                       {'endpoint': 'profile_bp.get_posts',
+                        'kind': 'dbstorage'})
+
+        response = self.client.get('/api/me/posts?stream=1', headers={
+            'Authorization': 'Bearer ' + self.access_token
+        }, buffered=False)
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', labels), latency
+        )
+
+        body = response.get_data()
+        response.close()
+
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', labels),
+            latency + 1
+        )
+        self.assertEqual(sample('http_response_size_bytes_sum', labels),
+                         size + len(body))
+        # iter_user_posts, only read while streaming
+        self.assertGreaterEqual(
+            sample('request_backend_calls_sum',
+                   {'endpoint': 'profile_bp.get_posts',
+                    'kind': 'dbstorage'}),
+            calls + 1
+        )
+
+    def test_nested_calls_are_counted_once(self):
+        """Test a DBStorage method's calls to other ones aren't counted
+        """
+        self.client.get('/api/me/posts', headers={
+            'Authorization': 'Bearer ' + self.access_token
+        })
+        with self.app.app_context():
+            db.find_user_posts(self.user_id)
+
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('backend_calls_total{endpoint="background",'
+                      'kind="dbstorage",name="find_user_posts"}', metrics)
+        self.assertNotIn('backend_calls_total{endpoint="background",'
+                         'kind="dbstorage",name="iter_user_posts"}', metrics)
+        self.assertIn('backend_calls_total{endpoint="profile_bp.get_posts",'
+                      'kind="dbstorage",name="iter_user_posts"}', metrics)
+
+    def test_metrics_not_served_by_default(self):
+        """Test /metrics is only served if SERVE_METRICS is set
+        """
+        client = create_app(TestConfig).test_client()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+
+    def test_slow_query_is_logged(self):
+        """Test a MongoDB command slower than SLOW_QUERY_MS is logged with
+        its query shape and route
+        """
+        command = {'find': 'posts', 'filter': {'user_id': self.user_id},
+                   'sort': {'datePosted': -1}}
+        event = SimpleNamespace(command=command, command_name='find',
+                                connection_id=('localhost', 27017),
+                                request_id=1, duration_micros=250000)
+
+        with self.app.test_request_context('/api/me/posts'):
+            self.app.preprocess_request()
+            with self.assertLogs('metrics', 'WARNING') as logs:
+                metrics.mongo_listener.started(event)
+                metrics.mongo_listener.succeeded(event)
+
+        # The filter's shape is logged, not its values
+        self.assertIn('posts', logs.output[0])
+        self.assertIn("'user_id': '?'", logs.output[0])
+        self.assertNotIn(self.user_id, logs.output[0])
+
+        # And counted
+        response = self.client.get('/metrics')
+        self.assertIn('mongo_slow_queries_total{collection="posts",'
+                      'command="find",endpoint="profile_bp.get_posts"} 1.0',
+                      response.get_data(as_text=True))
+
+    def test_fast_query_is_not_logged(self):
+        """Test a MongoDB command faster than SLOW_QUERY_MS isn't logged
+        """
+        event = SimpleNamespace(command={'find': 'users', 'filter': {}},
+                                command_name='find',
+                                connection_id=('localhost', 27017),
+                                request_id=2, duration_micros=1000)
+
+        with self.assertNoLogs('metrics', 'WARNING'):
+            metrics.mongo_listener.started(event)
+            metrics.mongo_listener.succeeded(event)
@@ -4,11 +4,13 @@
 from bson import ObjectId
 from config import TestConfig
 from datetime import datetime
-from db import db, redis_client as rc
+from db import activity, db, redis_client as rc
 from db.db_manager import hash_pass, check_hash_password
 from flask_jwt_extended import create_access_token
-from routes.auth import store_token
+from routes.auth import issue_tokens, store_token
 from main import create_app
+import jobs
+import json
 import string
 from time import sleep
 import random
@@ -310,13 +312,141 @@ class TestUpdateInfos(unittest.TestCase):
 
         # Verify response
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(data, {'success': 'user updated'})
+        self.assertEqual(data['success'], 'user updated')
+        self.assertIn('access_token', data)
+        self.assertIn('refresh_token', data)
 
         # Ensure the user was updated
         user = db.find_user({'_id': ObjectId(self.user_id)})
         self.assertEqual(user['email'], to_update['email'])
         self.assertEqual(user['username'], to_update['username'])
 
+    def test_stale_rename_job(self):
+        """Test a rename job leaves the copies alone once the user has
+        another username
+        """
+        user = db.find_user({'_id': ObjectId(self.user_id)})
+        post_id = db.insert_post({
+            'user_id': self.user_id,
+            'username': user['username'],
+            'title': 'My post',
+            'content': 'Here is my post',
+            'is_public': True,
+            'datePosted': datetime.utcnow()
+        })
+
+        with self.app.app_context():
+            job_id = jobs.enqueue('rename_user', user_id=self.user_id,
+                                  old_username=user['username'],
+                                  new_username='grindelwald00')
+
+        # The job is done, without renaming anything
+        self.assertEqual(jobs.status(job_id)['status'], 'done')
+        post = db.find_post({'_id': ObjectId(post_id)})
+        self.assertEqual(post['username'], user['username'])
+
+    def test_rename_to_used_username(self):
+        """Test renaming to another user's username is refused, and
+        issues no token carrying it
+        """
+        db.insert_user({
+            'username': 'severus60',
+            'email': 'always@poud.mgc',
+            'password': 'lily',
+            'longest_streak': 0
+        })
+        user = db.find_user({'_id': ObjectId(self.user_id)})
+        with self.app.app_context():
+            tokens = issue_tokens(self.user_id, {
+                'username': user['username'], 'epoch': 0
+            })
+
+        response = self.client.put('/api/me/update_infos', headers={
+            'Authorization': 'Bearer ' + tokens['access_token']
+        }, json={'username': 'severus60'})
+
+        # Verify response
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(),
+                         {'error': 'Username already used'})
+
+        # The user keeps their username, and their tokens
+        self.assertEqual(
+            db.find_user({'_id': ObjectId(self.user_id)})['username'],
+            user['username']
+        )
+        response = self.client.get('/api/', headers={
+            'Authorization': 'Bearer ' + tokens['access_token']
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['username'], user['username'])
+
+    def test_rename_reissues_tokens(self):
+        """Test renaming revokes the tokens carrying the old username
+        """
+        with self.app.app_context():
+            tokens = issue_tokens(self.user_id, {'username': 'albushog99',
+                                                 'epoch': 0})
+        headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+
+        response = self.client.put('/api/me/update_infos',
+                                   headers=headers,
+                                   json={'username': 'fawkes00'})
+        data = response.get_json()
+
+        # Verify response
+        self.assertEqual(response.status_code, 201)
+
+        # The old tokens are revoked
+        response = self.client.get('/api/', headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.post('/api/refresh', headers={
+            'Authorization': 'Bearer ' + tokens['refresh_token']
+        })
+        self.assertEqual(response.status_code, 401)
+
+        # The new ones carry the new username
+        response = self.client.get('/api/', headers={
+            'Authorization': 'Bearer ' + data['access_token']
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['username'], 'fawkes00')
+
+    def test_rename_propagates_username(self):
+        """Test renaming updates the username on the user's posts
+        """
+        post_id = db.insert_post({
+            'user_id': self.user_id,
+            'username': 'albushog99',
+            'title': 'My post',
+            'content': 'Here is my post',
+            'is_public': True,
+            'datePosted': datetime.utcnow()
+        })
+        with self.app.app_context():
+            tokens = issue_tokens(self.user_id, {'username': 'albushog99',
+                                                 'epoch': 0})
+
+        response = self.client.put('/api/me/update_infos', headers={
+            'Authorization': 'Bearer ' + tokens['access_token']
+        }, json={'username': 'dumbledore00'})
+        data = response.get_json()
+
+        # Verify response
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('job_id', data)
+
+        # The post carries the new username
+        post = db.find_post({'_id': ObjectId(post_id)})
+        self.assertEqual(post['username'], 'dumbledore00')
+
+        # The job ran, and reported its progress
+        job = jobs.status(data['job_id'])
+        self.assertEqual(job['name'], 'rename_user')
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['progress']['posts'], 1)
+
 
 class TestUpdatePassword(unittest.TestCase):
     """Tests for 'PUT /me/update_password' route
@@ -571,6 +701,145 @@ class TestGetPosts(unittest.TestCase):
         for data_dict, expected_dict in zip(data, self.posts):
             self.assertDictEqual(data_dict, expected_dict)
 
+    def test_get_posts_streamed(self):
+        """Test streaming posts as NDJSON
+        """
+        response = self.client.get('/api/me/posts', headers={
+            'Authorization': 'Bearer ' + self.access_token,
+            'Accept': 'application/x-ndjson'
+        })
+
+        # Verify response
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), len(self.posts))
+        for line in lines:
+            self.assertIn(json.loads(line), self.posts)
+
+
+class TestGetActivity(unittest.TestCase):
+    """Tests for 'GET /me/activity' route
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once before all tests
+        """
+
+        # Create app
+        cls.app = create_app(TestConfig)
+
+        # Create client
+        cls.client = cls.app.test_client()
+
+        # Create dummy user
+        infos = {
+            'username': 'albushog99',
+            'email': 'lumos@poud.mgc',
+            'password': 'gumbledore',
+            'longest_streak': 0
+        }
+        cls.user_id = str(db.insert_user(infos))
+
+        # Create JWT Access Token
+        with cls.app.app_context():
+            cls.access_token = create_access_token(
+                identity=cls.user_id
+            )
+
+        # Store JWT Access Token
+        store_token(
+            cls.user_id,
+            cls.access_token,
+            cls.app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+        )
+
+        cls.headers = {'Authorization': 'Bearer ' + cls.access_token}
+
+    @classmethod
+    def tearDownClass(cls):
+        """Clear Mongo and Redis databases
+        """
+        db.clear_db()
+        rc.flushdb()
+
+    def tearDown(self):
+        """Reset the user's activity and streaks after each test
+        """
+        activity.remove_user(self.user_id)
+        rc.delete('albushog99_CS')
+        db.delete_streak(self.user_id)
+
+    def test_get_activity(self):
+        """Test getting the entries of each day of a year
+        """
+        activity.add_entry(self.user_id, datetime(2023, 5, 2, 8))
+        activity.add_entry(self.user_id, datetime(2023, 5, 2, 22))
+        activity.add_entry(self.user_id, datetime(2023, 12, 31, 23))
+        activity.add_entry(self.user_id, datetime(2024, 1, 1))
+
+        response = self.client.get('/api/me/activity?year=2023',
+                                   headers=self.headers)
+
+        # Verify response
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {
+            'year': 2023,
+            'days': {'2023-05-02': 2, '2023-12-31': 1},
+            'total': 3
+        })
+
+    def test_log_and_delete_post(self):
+        """Test logging and deleting entries updates the activity
+        """
+        response = self.client.post('/api/log', headers=self.headers, json={
+            'title': 'My post',
+            'content': 'Here is my post'
+        })
+        post_id = response.get_json()['_id']
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+
+        response = self.client.get('/api/me/activity', headers=self.headers)
+        self.assertEqual(response.get_json()['days'], {today: 1})
+
+        self.client.delete('/api/me/delete_post', headers=self.headers,
+                           json={'post_id': post_id})
+
+        response = self.client.get('/api/me/activity', headers=self.headers)
+        self.assertEqual(response.get_json()['days'], {})
+        self.assertEqual(response.get_json()['total'], 0)
+
+    def test_backfill(self):
+        """Test counting the entries of existing posts
+        """
+        for hour in (8, 22):
+            db.insert_post({
+                'user_id': self.user_id,
+                'title': 'My post',
+                'content': 'Here is my post',
+                'is_public': False,
+                'datePosted': datetime(2022, 3, 4, hour)
+            })
+
+        activity.backfill(db.iter_daily_post_counts())
+
+        response = self.client.get('/api/me/activity?year=2022',
+                                   headers=self.headers)
+        self.assertEqual(response.get_json()['days'], {'2022-03-04': 2})
+
+    def test_with_wrong_year(self):
+        """Test getting the activity of a wrong year
+        """
+        response = self.client.get('/api/me/activity?year=last',
+                                   headers=self.headers)
+
+        # Verify response
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(),
+                         {'error': '`year` must be an integer'})
+
 
 class TestUpdateLog(unittest.TestCase):
     """Tests for 'PUT /me/update_post' route
@@ -10,7 +10,7 @@ function Posts() {
   const [username, setUsername] = useState('');
   const [posts, setPosts] = useState([]);
   const [comments, setComments] = useState({});
-  const [showAllLikes, setShowAllLikes] = useState(false);
+  const [commentsCursors, setCommentsCursors] = useState({});
   const [showComments, setShowComments] = useState(false);
   const [newCommentText, setNewCommentText] = useState('');
   const navigate = useNavigate();
@@ -71,6 +71,28 @@ function Posts() {
     }
   };
 
+  // Function to fetch a page of a post's comments
+  const fetchComments = async (postId, after = null) => {
+    try {
+      const res = await apiClient.post('/feed/post_comments', {
+        post_id: postId,
+        ...(after && { after }),
+      });
+      setComments((comments) => ({
+        ...comments,
+        [postId]: after
+          ? [...(comments[postId] || []), ...res.data.data]
+          : res.data.data,
+      }));
+      setCommentsCursors((cursors) => ({
+        ...cursors,
+        [postId]: res.data.next,
+      }));
+    } catch (error) {
+      console.error('Error fetching comments:', error);
+    }
+  };
+
   // Function to handle posting a new comment
   const handlePostComment = async (postId) => {
     console.log('postId'.postId);
@@ -88,8 +110,8 @@ function Posts() {
       setComments({
         ...comments,
         [postId]: comments[postId]
-          ? [...comments[postId], response.data]
-          : [response.data],
+          ? [...comments[postId], response.data.data]
+          : [response.data.data],
       });
     } catch (error) {
       console.error('Error posting comment:', error);
@@ -151,7 +173,7 @@ function Posts() {
 
                 <div className='mb-2'>
                   {/* Like OR Unlike button */}
-                  {post.likes.includes(username) ? (
+                  {post.liked_by_me ? (
                     <button
                       className='bg-white-500 text-blue-500 border border-blue-500 px-2 py-1 rounded mt-2 mr-1'
                       onClick={() => handleUnlikePost(post._id)}
@@ -167,47 +189,16 @@ function Posts() {
                     </button>
                   )}
 
-                  {/* Display usernames of users who liked the post */}
+                  {/* Display the number of users who liked the post */}
                   <p className='text-sm inline text-gray-700 mt-2'>
                     {post.number_of_likes > 0 && (
                       <>
-                        Liked by {post.likes[0]}
-                        {post.number_of_likes > 1 && (
-                          <>
-                            {' '}
-                            {!showAllLikes && (
-                              <>
-                                and {post.number_of_likes - 1} other
-                                {post.number_of_likes > 2 ? 's' : ''}.
-                                <button
-                                  className='text-orange underline ml-1'
-                                  onClick={() => setShowAllLikes(true)}
-                                >
-                                  Show all
-                                </button>
-                              </>
-                            )}
-                            {showAllLikes && (
-                              <>
-                                {', '}
-                                {post.likes.slice(1).map((like, index) => (
-                                  <span key={like}>
-                                    {like}
-                                    {index < post.number_of_likes - 2
-                                      ? ', '
-                                      : '.'}
-                                  </span>
-                                ))}
-                                <button
-                                  className='text-black underline ml-1'
-                                  onClick={() => setShowAllLikes(false)}
-                                >
-                                  Hide
-                                </button>
-                              </>
-                            )}
-                          </>
-                        )}
+                        Liked by{' '}
+                        {post.liked_by_me
+                          ? post.number_of_likes > 1
+                            ? `you and ${post.number_of_likes - 1} other${post.number_of_likes > 2 ? 's' : ''}.`
+                            : 'you.'
+                          : `${post.number_of_likes} user${post.number_of_likes > 1 ? 's' : ''}.`}
                       </>
                     )}
                     {post.number_of_likes === 0 && <span>No likes yet</span>}
@@ -235,7 +226,10 @@ function Posts() {
                     showComments === false ? (
                       <button
                         className='text-orange underline px-2 py-1 rounded mt-2 mb-2'
-                        onClick={() => setShowComments(true)}
+                        onClick={() => {
+                          setShowComments(true);
+                          fetchComments(post._id);
+                        }}
                       >
                         Show {post.number_of_comments} Comment
                         {post.number_of_comments > 1 && 's'}
@@ -258,8 +252,8 @@ function Posts() {
                     <>
                       {/* Display comments */}
                       <div>
-                        {post.comments &&
-                          post.comments.map((comment) => (
+                        {(comments[post._id] || post.comments || []).map(
+                          (comment) => (
                             <div
                               key={comment._id}
                               className='border border-gray-300 rounded p-2 mb-2'
@@ -280,7 +274,18 @@ function Posts() {
                                 Delete
                               </button>
                             </div>
-                          ))}
+                          )
+                        )}
+                        {commentsCursors[post._id] && (
+                          <button
+                            className='text-orange underline px-2 py-1 rounded mb-2'
+                            onClick={() =>
+                              fetchComments(post._id, commentsCursors[post._id])
+                            }
+                          >
+                            Load more comments
+                          </button>
+                        )}
                       </div>
                     </>
                   )}
@@ -39,6 +39,15 @@ function UpdateInfo() {
       const response = await apiClient.put('/me/update_infos', userInfo);
 
       if (response.status == 201) {
+        // A new username comes with new JWT Tokens
+        if (response.data.access_token) {
+          localStorage.setItem('jwt_access_token', response.data.access_token);
+          localStorage.setItem(
+            'jwt_refresh_token',
+            response.data.refresh_token
+          );
+        }
+
         navigate('/profile', {
           state: { successMessage: 'Your infos were updated successfully !' },
         });